@@ -1,38 +1,224 @@
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
 import logging
-from logging.handlers import RotatingFileHandler
-from fastapi import Request
-from fastapi.responses import JSONResponse
+import os
+import queue
+import random
+import sys
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, ORJSONResponse
+from config import settings
+
+
+class BatchedRotatingFileHandler(RotatingFileHandler):
+    """Rotating file handler that leaves flushing to the listener, which flushes once per batch."""
+
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+
+class BatchingQueueListener(QueueListener):
+    """Writes queued records from a background thread, draining everything queued at once."""
+
+    def _monitor(self):
+        while True:
+            batch = [self.dequeue(True)]
+            while len(batch) < settings.LOG_BATCH_SIZE:
+                try:
+                    batch.append(self.dequeue(False))
+                except queue.Empty:
+                    break
+            stop = False
+            for record in batch:
+                if record is self._sentinel:
+                    stop = True
+                else:
+                    self.handle(record)
+            for handler in self.handlers:
+                if isinstance(handler, BatchedRotatingFileHandler):
+                    handler.flush_batch()
+                else:
+                    handler.flush()
+            if stop:
+                break
+
+
+class DeferredQueueHandler(QueueHandler):
+    """Queues records as they are, so message formatting happens on the listener thread.
+
+    While no listener is running, records go to ``fallback`` straight away instead, so a
+    process that never calls start_logging still sees its log, errors included.
+    """
+
+    def __init__(self, queue, fallback: logging.Handler):
+        super().__init__(queue)
+        self.fallback = fallback
+
+    def prepare(self, record):
+        return record
+
+    def emit(self, record):
+        if log_listener is None:
+            self.fallback.handle(record)
+        else:
+            super().emit(record)
+
+
+class ConsoleHandler(logging.StreamHandler):
+    """Writes to whatever ``sys.stderr`` is at emit time rather than at import time."""
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+
+    @property
+    def stream(self):
+        return sys.stderr
+
+
+class SamplingFilter(logging.Filter):
+    """Lets through a ``rate`` fraction of records below WARNING."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno >= logging.WARNING or random.random() < self.rate
 
-app = FastAPI(
-    debug=True
-)
 
 logging.basicConfig(level=logging.INFO)
 formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 
-global_logger = logging.getLogger(__name__)
-global_file_handler = RotatingFileHandler('logs/critical.log', maxBytes=1024 * 1024, backupCount=5)
-global_file_handler.setLevel(logging.ERROR)
-global_file_handler.setFormatter(formatter)
-global_logger.addHandler(global_file_handler)
-
-auth_logger = logging.getLogger(__name__)
-auth_file_handler = RotatingFileHandler('logs/authentication.log', maxBytes=1024 * 1024, backupCount=5)
-auth_file_handler.setLevel(logging.INFO)
-auth_file_handler.setFormatter(formatter)
-auth_logger.addHandler(auth_file_handler)
-
-posts_logger = logging.getLogger(__name__)
-posts_file_handler = RotatingFileHandler('logs/post_interactions.log', maxBytes=1024 * 1024, backupCount=5)
-posts_file_handler.setLevel(logging.INFO)
-posts_file_handler.setFormatter(formatter)
-posts_logger.addHandler(posts_file_handler)
-
-@app.exception_handler(Exception)  # doesn't work right now
+
+def file_handler(path, level, logger_name=None):
+    handler = BatchedRotatingFileHandler(path, maxBytes=1024 * 1024, backupCount=5, delay=True)
+    handler.setLevel(level)
+    handler.setFormatter(formatter)
+    if logger_name:
+        handler.addFilter(logging.Filter(logger_name))
+    return handler
+
+
+console_handler = ConsoleHandler()
+console_handler.setFormatter(logging.Formatter('%(levelname)s:%(name)s:%(message)s'))
+
+# records wait here for the listener thread that start_logging starts
+log_queue = queue.SimpleQueue()
+log_listener = None
+queue_handler = DeferredQueueHandler(log_queue, console_handler)
+
+
+def start_logging(log_dir: str = settings.LOG_DIR) -> BatchingQueueListener:
+    """Open the log files in ``log_dir`` and start writing queued records from a background thread."""
+    global log_listener
+    if log_listener is None:
+        os.makedirs(log_dir, exist_ok=True)
+        listener = BatchingQueueListener(
+            log_queue,
+            console_handler,
+            file_handler(os.path.join(log_dir, 'critical.log'), logging.ERROR),
+            file_handler(os.path.join(log_dir, 'authentication.log'), logging.INFO, 'apps.auth'),
+            file_handler(os.path.join(log_dir, 'post_interactions.log'), logging.INFO, 'apps.posts'),
+            respect_handler_level=True,
+        )
+        listener.start()
+        log_listener = listener
+    return log_listener
+
+
+def stop_logging():
+    """Write what is still queued and close the log files."""
+    global log_listener
+    # emit runs under the handler lock, so every record queued before the swap is ahead of
+    # the listener's stop sentinel and every record after it goes to the fallback
+    with queue_handler.lock:
+        listener, log_listener = log_listener, None
+    if listener is not None:
+        listener.stop()
+        for handler in listener.handlers:
+            if handler is not console_handler:
+                handler.close()
+
+
+global_logger = logging.getLogger('apps')
+global_logger.setLevel(logging.INFO)
+global_logger.addHandler(queue_handler)
+global_logger.propagate = False
+
+auth_logger = logging.getLogger('apps.auth')
+db_logger = logging.getLogger('apps.db')
+posts_logger = logging.getLogger('apps.posts')
+# reads outnumber every other event, only a sample of them is kept
+posts_read_logger = logging.getLogger('apps.posts.read')
+posts_read_logger.addFilter(SamplingFilter(settings.LOG_READ_SAMPLE_RATE))
+
+
 async def global_exception_handler(request: Request, exc: Exception):
-    global_logger.error(f"Unhandled exception: {exc}", exc_info=True)
+    global_logger.error("Unhandled exception: %s", exc, exc_info=True)
     return JSONResponse(
         status_code=500,
         content={"detail": "Internal server error"},
     )
+
+
+def create_app() -> FastAPI:
+    """Build the application with every route and middleware, configured from config.settings.
+
+    Nothing is opened here: the lifespan starts logging and creates the database engines
+    on startup, and flushes the like buffer, disposes the engines, stops the password
+    hashing processes and closes the log files on shutdown. The engines, like the caches and the like buffer, belong to the process
+    rather than to one app: every app built here uses the same ones, and the first to shut
+    down disposes them for all (they are created again on next use).
+    """
+    from starlette.middleware.cors import CORSMiddleware
+    from apps import hashing
+    from apps.dependencies import open_engines, close_engines, like_buffer
+    from apps.metrics import MetricsMiddleware
+    from apps.query_stats import QueryStatsMiddleware
+    from apps.routes import secure_router, guest_router, admin_router, asyncify_router, verify_token
+    # noinspection PyUnresolvedReferences
+    from apps.routes import auth, posts, users, admin
+
+    @asynccontextmanager
+    async def lifespan(application: FastAPI):
+        start_logging(settings.LOG_DIR)
+        open_engines()
+        try:
+            yield
+        finally:
+            like_buffer.stop()
+            await close_engines()
+            hashing.shutdown_pool()
+            stop_logging()
+
+    application = FastAPI(
+        debug=settings.DEBUG,
+        default_response_class=ORJSONResponse,
+        lifespan=lifespan,
+    )
+    # only used with DEBUG off, in debug mode Starlette answers with its traceback page instead
+    application.add_exception_handler(Exception, global_exception_handler)
+    application.add_middleware(
+        CORSMiddleware,
+        allow_origins=["*"],
+        allow_credentials=True,
+        allow_methods=["*"],
+        allow_headers=["*"],
+    )
+    application.middleware("http")(verify_token)
+    application.add_middleware(QueryStatsMiddleware)
+    application.add_middleware(MetricsMiddleware)
+    for router in (secure_router, guest_router, admin_router):
+        application.include_router(asyncify_router(router) if settings.ASYNC_DB else router)
+    return application
+
+
+def __getattr__(name):
+    # ``from apps import app`` builds the default app on first use instead of on import
+    if name == "app":
+        globals()["app"] = application = create_app()
+        return application
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
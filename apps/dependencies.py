@@ -1,15 +1,158 @@
-from sqlalchemy.orm import sessionmaker, aliased
-from sqlalchemy import create_engine, func
-import bcrypt
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from binascii import Error as Base64Error
+from collections import defaultdict
+from typing import NamedTuple
+import json
+import logging
+import time
+from sqlalchemy.orm import Session, sessionmaker, aliased, object_session
+from sqlalchemy import create_engine, event, func, literal, make_url, select, true, tuple_
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool, StaticPool
 import jwt
+from apps import global_logger
+from apps.cache import LRUCache
+from apps.hashing import hash_password, check_password, needs_rehash
+from apps.like_buffer import LikeBuffer
+from apps.metrics import Counter, Gauge, db_checkout_wait, registry
+from apps.response_cache import response_cache
+from apps import hashing
 from config import settings
 from datetime import datetime, timedelta
-from fastapi import Request, HTTPException, Depends
-from database.models import User, Post, Like
+from fastapi import Request, HTTPException, Depends, Query
+from database.models import User, Post, Followers
 
-engine = create_engine("postgresql://postgres:@localhost/fastapi")
+class TimedCheckout:
+    """Pool mixin recording how long each checkout waited for a connection and logging slow ones."""
 
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.perf_counter() - start
+            db_checkout_wait.observe(waited)
+            if waited >= settings.DB_SLOW_CHECKOUT:
+                global_logger.warning("Slow connection pool checkout: waited=%.3fs, pool=%s", waited, self.status())
+
+class TimedQueuePool(TimedCheckout, QueuePool):
+    pass
+
+class TimedAsyncAdaptedQueuePool(TimedCheckout, AsyncAdaptedQueuePool):
+    pass
+
+# SQLAlchemy names pool loggers after the pool class, which puts these under the INFO level
+# "apps" logger; keep the pool's own INFO chatter (every dispose and recreate) out of it
+logging.getLogger(__name__).setLevel(logging.WARNING)
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA cache_size={settings.SQLITE_CACHE_SIZE}")
+    cursor.close()
+
+def create_db_engine(url: str, asynchronous: bool = False):
+    """Create the engine for ``url`` with the pool settings from config.settings.
+
+    SQLite files run in WAL mode with synchronous=NORMAL, which is safe with WAL and
+    avoids an fsync per commit.
+    """
+    url = make_url(url)
+    options = {}
+    sqlite = url.get_backend_name() == "sqlite"
+    if sqlite:
+        # sessions move between threadpool threads
+        options["connect_args"] = {"check_same_thread": False}
+    if sqlite and url.database in (None, "", ":memory:"):
+        # a single shared connection, otherwise every thread would see its own empty database
+        options["poolclass"] = StaticPool
+    else:
+        options.update(
+            poolclass=TimedAsyncAdaptedQueuePool if asynchronous else TimedQueuePool,
+            pool_size=settings.DB_POOL_SIZE,
+            max_overflow=settings.DB_MAX_OVERFLOW,
+            pool_timeout=settings.DB_POOL_TIMEOUT,
+            pool_pre_ping=settings.DB_POOL_PRE_PING,
+            pool_recycle=settings.DB_POOL_RECYCLE,
+        )
+    if asynchronous:
+        db_engine = create_async_engine(url, **options)
+        sync_engine = db_engine.sync_engine
+    else:
+        db_engine = sync_engine = create_engine(url, **options)
+    if sqlite:
+        event.listen(sync_engine, "connect", set_sqlite_pragmas)
+    return db_engine
+
+_engine = None
+_async_engine = None
+
+def get_engine():
+    """The engine of the process, created from DATABASE_URL on first use."""
+    global _engine
+    if _engine is None:
+        _engine = create_db_engine(settings.DATABASE_URL)
+    return _engine
+
+def get_async_engine():
+    global _async_engine
+    if _async_engine is None:
+        _async_engine = create_db_engine(settings.ASYNC_DATABASE_URL, asynchronous=True)
+    return _async_engine
+
+def open_engines():
+    """Create the engines of the process if they are not there yet; every app shares them."""
+    get_engine()
+    if settings.ASYNC_DB:
+        AsyncSessionLocal.configure(bind=get_async_engine())
+
+async def close_engines():
+    """Close every pooled connection; the engines are created again when next used."""
+    global _engine, _async_engine
+    if _engine is not None:
+        _engine.dispose()
+        _engine = None
+    if _async_engine is not None:
+        await _async_engine.dispose()
+        _async_engine = None
+        AsyncSessionLocal.configure(bind=None)
+
+def __getattr__(name):
+    # ``from apps.dependencies import engine`` creates the engine then, not on import
+    if name == "engine":
+        return get_engine()
+    if name == "async_engine":
+        return get_async_engine()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+class AppSession(Session):
+    """Session that binds itself to ``get_engine()`` when it first needs a connection."""
+
+    def get_bind(self, mapper=None, **kwargs):
+        if self.bind is None:
+            self.bind = get_engine()
+        return super().get_bind(mapper, **kwargs)
+
+SessionLocal = sessionmaker(class_=AppSession, autocommit=False, autoflush=False)
+
+like_buffer = LikeBuffer(SessionLocal)
+
+AsyncSessionLocal = async_sessionmaker(autoflush=False)
+
+def pool_stats():
+    pools = {name: db_engine.pool for name, db_engine in (("sync", _engine), ("async", _async_engine))
+             if db_engine is not None}
+    return {(name, state): getattr(pool, state)()
+            for name, pool in pools.items() if isinstance(pool, QueuePool)
+            for state in ("size", "checkedout", "checkedin")}
+
+registry.register(Gauge("db_pool_connections", "Pool size and connections checked out of and into the pool.",
+                        labels=("pool", "state"), callback=pool_stats))
+registry.register(Gauge("bcrypt_queue_depth", "Password hashing jobs waiting for or running in the pool.",
+                        callback=hashing.queue_depth))
+registry.register(Gauge("like_buffer_pending", "Likes and unlikes not written to the database yet.",
+                        callback=like_buffer.pending))
 
 def get_db():
     db = SessionLocal()
@@ -18,13 +161,9 @@ def get_db():
     finally:
         db.close()
 
-def hash_password(password: str) -> str:
-    salt = bcrypt.gensalt()
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
-    return hashed_password.decode('utf-8')
-
-def check_password(plain_password: str, hashed_password: str) -> bool:
-    return bcrypt.checkpw(plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
 
 def create_access_token(data: dict):
     to_encode = data.copy()
@@ -33,6 +172,19 @@ def create_access_token(data: dict):
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
+token_cache = LRUCache(settings.TOKEN_CACHE_SIZE)
+
+def decode_token(token: str) -> dict:
+    """Verify a token and return its claims, reusing the claims of tokens seen before until they expire.
+
+    The returned dict is shared between requests and must not be modified.
+    """
+    payload = token_cache.get(token)
+    if payload is None:
+        payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+        token_cache.set(token, payload, expires_at=payload.get("exp"))
+    return payload
+
 def check_auth(request: Request):
     token = request.cookies.get("access_token")
 
@@ -41,39 +193,320 @@ def check_auth(request: Request):
 
     return True
 
-def check_admin(request: Request,
-                db: SessionLocal = Depends(get_db)):
-    user = db.query(User).filter(User.username == request.state.user.get("sub")).first()
+class Identity(NamedTuple):
+    id: int
+    username: str
+    role_id: int
+
+identity_cache = LRUCache(settings.IDENTITY_CACHE_SIZE, ttl=settings.IDENTITY_CACHE_TTL)
+
+profile_cache = LRUCache(settings.PROFILE_CACHE_SIZE, ttl=settings.PROFILE_CACHE_TTL)
+
+def cache_stats(stat):
+    caches = {"token": token_cache, "identity": identity_cache, "profile": profile_cache, "response": response_cache}
+    return lambda: {(name,): cache.stats()[stat] for name, cache in caches.items()}
+
+registry.register(Gauge("cache_entries", "Entries held by the in-process caches.",
+                        labels=("cache",), callback=cache_stats("size")))
+registry.register(Counter("cache_hits_total", "Lookups answered by the in-process caches.",
+                          labels=("cache",), callback=cache_stats("hits")))
+registry.register(Counter("cache_misses_total", "Lookups the in-process caches could not answer.",
+                          labels=("cache",), callback=cache_stats("misses")))
+registry.register(Gauge("response_cache_bytes", "Size of the bodies held by the response cache.",
+                        callback=lambda: response_cache.size))
+
+# Users updated through the ORM are dropped from the identity and profile caches once their
+# transaction commits: dropping them at flush would let a concurrent request cache the old
+# row again for a full TTL. Bulk ``query(User).update(...)`` does not go through here, code
+# that changes usernames or roles that way has to pop the caches itself after committing.
+@event.listens_for(User, "after_update")
+def invalidate_identity(mapper, connection, user):
+    object_session(user).info.setdefault("updated_users", set()).add(user.id)
+
+@event.listens_for(Session, "after_commit")
+def clear_updated_users(session):
+    for user_id in session.info.pop("updated_users", ()):
+        identity_cache.pop(user_id)
+        profile_cache.pop(user_id)
+
+@event.listens_for(Session, "after_rollback")
+def forget_updated_users(session):
+    session.info.pop("updated_users", None)
+
+def get_identity(request: Request,
+                 db: SessionLocal = Depends(get_db)) -> Identity:
+    """Resolve the signed in user once per request, from the identity cache when possible."""
+    claims = request.state.user
+    if not claims:
+        raise HTTPException(status_code=401, detail="Sign in first", headers={"Location": "/"})
+    if (user_id := claims.get("uid")) is not None:
+        if (identity := identity_cache.get(user_id)) is not None:
+            return identity
+        user = db.query(User.id, User.username, User.role_id).filter(User.id == user_id).first()
+    else:
+        # tokens issued before the uid claim existed
+        user = db.query(User.id, User.username, User.role_id).filter(User.username == claims.get("sub")).first()
+    if not user:
+        raise HTTPException(status_code=401, detail="Sign in again", headers={"Location": "/"})
+    identity = Identity(*user)
+    identity_cache.set(identity.id, identity)
+    return identity
+
+def check_admin(user: Identity = Depends(get_identity)):
     if user.role_id != 2:
         raise HTTPException(status_code=401, detail="This is protected route", headers={"Location": "/"})
 
+def get_profile(user_id: int, db) -> dict | None:
+    """Profile stats of a user, computed by a single query and cached for PROFILE_CACHE_TTL seconds.
+
+    Follows and unfollows, new posts and hidden posts pop the users they change; likes
+    received are only refreshed by the TTL.
+    """
+    if (profile := profile_cache.get(user_id)) is not None:
+        return profile
+    following = select(func.count(Followers.id)). \
+        filter(Followers.follower_id == User.id). \
+        correlate(User). \
+        scalar_subquery()
+    posts = select(func.count(Post.id)). \
+        filter(Post.user_id == User.id). \
+        filter(Post.hidden == bool(0)). \
+        filter(Post.type == 1). \
+        correlate(User). \
+        scalar_subquery()
+    likes = select(func.coalesce(func.sum(Post.like_count), 0)). \
+        filter(Post.user_id == User.id). \
+        filter(Post.hidden == bool(0)). \
+        correlate(User). \
+        scalar_subquery()
+    user = db.query(User.username, User.last_seen, User.followers_count, following, posts, likes). \
+        filter(User.id == user_id). \
+        first()
+    if not user:
+        return None
+    profile = {
+        "username": user.username,
+        "last_seen": user.last_seen,
+        "followers": user.followers_count,
+        "following": user[3],
+        "posts": user[4],
+        "likes": user[5],
+    }
+    profile_cache.set(user_id, profile)
+    return profile
+
 def get_current_user(request: Request):
     if request.cookies.get("access_token"):
         return request.state.user.get("sub")
     else:
         return None
 
-def get_comments(post_id, db):
-    parent_comment = aliased(Post)
-    child_comment = aliased(Post)
+class CommentLimits(NamedTuple):
+    """How much of each comment tree a response includes; None means no limit."""
+    max_depth: int | None = None
+    max_children: int | None = None
 
-    comments = db.query(child_comment). \
-        join(parent_comment, parent_comment.id == child_comment.refer_to). \
-        filter(parent_comment.id == post_id). \
-        filter(child_comment.hidden == bool(0)). \
-        with_entities(child_comment)
+def comment_limits(max_depth: int = Query(settings.COMMENT_MAX_DEPTH, ge=0, le=settings.COMMENT_DEPTH_LIMIT),
+                   max_children: int = Query(settings.COMMENT_MAX_CHILDREN, ge=1,
+                                             le=settings.COMMENT_CHILDREN_LIMIT)) -> CommentLimits:
+    return CommentLimits(max_depth, max_children)
 
-    comment_list = []
-    for comment in comments:
-        comment_data = {
-            'id': comment.id,
+def mark_truncated(node: dict, replies: list, reply_count: int):
+    """Give a node whose replies were cut short its reply count and the cursor of the replies left out.
+
+    The cursor is the ``after`` of ``/posts/{id}/replies`` for the next reply not included.
+    """
+    if reply_count > len(replies):
+        node['reply_count'] = reply_count
+        node['cursor'] = encode_cursor(replies[-1]['id'] if replies else 0)
+
+def comment_to_json(comment, answers: list) -> dict:
+    return {'id': comment.id,
             'title': comment.title,
             'content': comment.content,
-            'user': comment.user.username,
-            'date': str(comment.created_at),
-            'likes': db.query(func.count(Like.post_id)).filter(Like.post_id == comment.id).scalar(),
-            'answers': get_comments(comment.id, db)
-        }
-        comment_list.append(comment_data)
-
-    return comment_list
+            'user': comment.username,
+            'date': comment.created_at,
+            'likes': like_buffer.like_count(comment.id, comment.like_count),
+            'answers': answers}
+
+def comment_columns():
+    return Post.id, Post.refer_to, Post.title, Post.content, User.username, Post.created_at, \
+        Post.like_count, Post.comment_count
+
+def get_comment_trees(post_ids, db, limits: CommentLimits = CommentLimits()):
+    """Load the comment trees of several posts with a single recursive query.
+
+    Returns a dict mapping every given post id to the list of its comments,
+    each comment nesting its own answers the same way. With ``limits``, the trees stop
+    ``max_depth`` levels below the posts and keep the oldest ``max_children`` replies of
+    every node; nodes with replies left out get a ``reply_count`` and a ``cursor``, see
+    ``mark_truncated``. The replies left out of the posts themselves are for the caller to mark.
+    """
+    post_ids = list(post_ids)
+    trees = {post_id: [] for post_id in post_ids}
+    if not post_ids or limits.max_depth == 0:
+        return trees
+
+    child_comment = aliased(Post)
+
+    # the posts themselves are the depth 0 rows, the replies of each node are joined from there
+    tree = db.query(Post.id, literal(0).label("depth")). \
+        filter(Post.id.in_(post_ids)). \
+        cte(name="comment_tree", recursive=True)
+    if limits.max_children is None:
+        replies = db.query(child_comment.id, (tree.c.depth + 1).label("depth")). \
+            join(tree, child_comment.refer_to == tree.c.id). \
+            filter(child_comment.hidden == bool(0))
+    else:
+        # the oldest max_children replies of each node, read straight from ix_posts_refer_to
+        # instead of numbering every reply of a popular node to keep a few of them
+        first_replies = select(Post.id). \
+            filter(Post.refer_to == tree.c.id). \
+            filter(Post.hidden == bool(0)). \
+            order_by(Post.id). \
+            limit(limits.max_children)
+        if db.get_bind().dialect.name == "postgresql":
+            # Postgres runs a correlated IN (... LIMIT) as a filter re-evaluated for every
+            # row of the join, a lateral join runs the index scan once per node
+            first_replies = first_replies.lateral("first_replies")
+            replies = db.query(first_replies.c.id, (tree.c.depth + 1).label("depth")). \
+                select_from(tree). \
+                join(first_replies, true())
+        else:
+            # SQLite has no LATERAL, it plans the IN as a correlated subquery per node
+            replies = db.query(child_comment.id, (tree.c.depth + 1).label("depth")). \
+                select_from(tree). \
+                join(child_comment, child_comment.id.in_(first_replies))
+    if limits.max_depth is not None:
+        replies = replies.filter(tree.c.depth < limits.max_depth)
+    tree = tree.union_all(replies)
+
+    comments = db.query(*comment_columns()). \
+        join(tree, tree.c.id == Post.id). \
+        join(User, User.id == Post.user_id). \
+        filter(tree.c.depth > 0). \
+        order_by(Post.id)
+
+    answers = defaultdict(list)
+    nodes = []
+    for comment in comments:
+        node = comment_to_json(comment, answers[comment.id])
+        answers[comment.refer_to].append(node)
+        nodes.append((node, comment.comment_count))
+
+    if limits != CommentLimits():
+        for node, reply_count in nodes:
+            mark_truncated(node, node['answers'], reply_count)
+    for post_id in post_ids:
+        trees[post_id] = answers[post_id]
+    return trees
+
+def get_comments(post_id, db, limits: CommentLimits = CommentLimits()):
+    return get_comment_trees([post_id], db, limits)[post_id]
+
+def posts_to_json(posts, db, limits: CommentLimits = CommentLimits()):
+    comments = get_comment_trees([post.id for post in posts], db, limits)
+    posts_json = []
+    for post in posts:
+        post_json = {'id': post.id,
+                     'title': post.title,
+                     'content': post.content,
+                     'user': post.user.username,
+                     'date': post.created_at,
+                     'likes': like_buffer.like_count(post.id, post.like_count),
+                     'comments': comments[post.id]}
+        if limits != CommentLimits():
+            mark_truncated(post_json, post_json['comments'], post.comment_count)
+        posts_json.append(post_json)
+    return posts_json
+
+def get_replies(post_id: int, db, limits: CommentLimits, after: str | None = None):
+    """One page of the replies to a post, comment or answer, oldest first, with their own trees.
+
+    Pages hold ``max_children`` replies and each reply counts as the first of ``max_depth``
+    levels. Returns the replies and the cursor of the next page.
+    """
+    after_id = 0
+    if after:
+        try:
+            after_id, = decode_cursor(after)
+            after_id = int(after_id)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    page_size = limits.max_children or settings.COMMENT_CHILDREN_LIMIT
+    replies = db.query(*comment_columns()). \
+        join(User, User.id == Post.user_id). \
+        filter(Post.refer_to == post_id). \
+        filter(Post.hidden == bool(0)). \
+        filter(Post.id > after_id). \
+        order_by(Post.id). \
+        limit(page_size + 1).all()
+    next_cursor = None
+    if len(replies) > page_size:
+        replies = replies[:page_size]
+        next_cursor = encode_cursor(replies[-1].id)
+    depth = None if limits.max_depth is None else max(limits.max_depth - 1, 0)
+    trees = get_comment_trees([reply.id for reply in replies], db, limits._replace(max_depth=depth))
+    replies_json = []
+    for reply in replies:
+        node = comment_to_json(reply, trees[reply.id])
+        mark_truncated(node, node['answers'], reply.comment_count)
+        replies_json.append(node)
+    return replies_json, next_cursor
+
+def encode_cursor(*values):
+    raw = json.dumps([value.isoformat() if isinstance(value, datetime) else value for value in values])
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('utf-8').rstrip("=")
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        values = json.loads(urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (Base64Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if not isinstance(values, list):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+def paginate_posts_by_page(posts_query, page: int):
+    return posts_query. \
+        order_by(Post.created_at.desc(), Post.id.desc()). \
+        offset((page - 1) * settings.POSTS_PER_PAGE). \
+        limit(settings.POSTS_PER_PAGE).all()
+
+def decode_post_cursor(after: str) -> tuple[datetime, int]:
+    try:
+        created_at, post_id = decode_cursor(after)
+        return datetime.fromisoformat(created_at), int(post_id)
+    except (TypeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def paginate_posts_by_score(posts_query, score, after: str | None):
+    """Return one page of posts highest ``score`` first, seeking past the (score, id) of the after cursor."""
+    if after:
+        try:
+            after_score, after_id = decode_cursor(after)
+            position = float(after_score), int(after_id)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        posts_query = posts_query.filter(tuple_(score, Post.id) < position)
+    posts = posts_query. \
+        order_by(score.desc(), Post.id.desc()). \
+        limit(settings.POSTS_PER_PAGE + 1).all()
+    next_cursor = None
+    if len(posts) > settings.POSTS_PER_PAGE:
+        posts = posts[:settings.POSTS_PER_PAGE]
+        next_cursor = encode_cursor(getattr(posts[-1], score.key), posts[-1].id)
+    return posts, next_cursor
+
+def paginate_posts_by_cursor(posts_query, after: str | None):
+    """Return one page of posts newer-first, seeking past the (created_at, id) of the after cursor."""
+    if after:
+        posts_query = posts_query.filter(tuple_(Post.created_at, Post.id) < decode_post_cursor(after))
+    posts = posts_query. \
+        order_by(Post.created_at.desc(), Post.id.desc()). \
+        limit(settings.POSTS_PER_PAGE + 1).all()
+    next_cursor = None
+    if len(posts) > settings.POSTS_PER_PAGE:
+        posts = posts[:settings.POSTS_PER_PAGE]
+        next_cursor = encode_cursor(posts[-1].created_at, posts[-1].id)
+    return posts, next_cursor
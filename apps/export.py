@@ -0,0 +1,48 @@
+import orjson
+
+from apps.dependencies import SessionLocal
+from config import settings
+from database.models import Post, User
+
+
+def export_posts_query(db, user_id=None, since=None, until=None, include_hidden=False, include_comments=False):
+    query = db.query(Post.id, Post.type, Post.refer_to, Post.title, Post.content,
+                     Post.user_id, User.username.label('user'), Post.created_at.label('date'),
+                     Post.like_count.label('likes'), Post.comment_count.label('comments'), Post.hidden). \
+        join(User, User.id == Post.user_id)
+    if user_id is not None:
+        query = query.filter(Post.user_id == user_id)
+    if since is not None:
+        query = query.filter(Post.created_at >= since)
+    if until is not None:
+        query = query.filter(Post.created_at < until)
+    if not include_hidden:
+        query = query.filter(Post.hidden == bool(0))
+    if not include_comments:
+        query = query.filter(Post.type == 1)
+    return query.order_by(Post.id)
+
+
+def export_posts_ndjson(db, **filters):
+    """Yield the matching posts as NDJSON, one chunk per ``EXPORT_BATCH_SIZE`` rows.
+
+    Rows are fetched through ``yield_per``, which streams them from a server-side cursor
+    where the driver supports it, so memory use does not grow with the export.
+    """
+    chunk = []
+    for row in export_posts_query(db, **filters).yield_per(settings.EXPORT_BATCH_SIZE):
+        chunk.append(orjson.dumps(row._asdict()))
+        if len(chunk) == settings.EXPORT_BATCH_SIZE:
+            yield b"\n".join(chunk) + b"\n"
+            chunk = []
+    if chunk:
+        yield b"\n".join(chunk) + b"\n"
+
+
+def stream_posts_export(**filters):
+    """``export_posts_ndjson`` over a session that lives exactly as long as the response body."""
+    db = SessionLocal()
+    try:
+        yield from export_posts_ndjson(db, **filters)
+    finally:
+        db.close()
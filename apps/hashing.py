@@ -0,0 +1,99 @@
+import asyncio
+import os
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from threading import BoundedSemaphore, Lock
+
+from fastapi import HTTPException
+from sqlalchemy.util.concurrency import await_only, in_greenlet
+
+from config import settings
+
+# bcrypt is CPU bound and holds the worker thread for its whole run, so it goes to a small
+# process pool. The semaphore bounds how many hashes may be queued or running at once.
+_pool = None
+_pool_lock = Lock()
+_slots = BoundedSemaphore(settings.BCRYPT_QUEUE_SIZE)
+_queued = 0
+_queued_lock = Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(max_workers=settings.BCRYPT_WORKERS)
+        return _pool
+
+
+# bcrypt is only imported by the pool processes that run these
+def _hash(password: bytes, rounds: int) -> bytes:
+    import bcrypt
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _check(password: bytes, hashed_password: bytes) -> bool:
+    import bcrypt
+    return bcrypt.checkpw(password, hashed_password)
+
+
+def _release(future=None):
+    global _queued
+    with _queued_lock:
+        _queued -= 1
+    _slots.release()
+
+
+def _run(function, *args):
+    global _queued
+    if not _slots.acquire(blocking=False):
+        raise HTTPException(status_code=503, detail="Server is busy, try again later",
+                            headers={"Retry-After": "1"})
+    with _queued_lock:
+        _queued += 1
+    try:
+        future = _get_pool().submit(function, *args)
+    except BaseException:
+        _release()
+        raise
+    # the slot is held until the job is done: a job that already started cannot be cancelled
+    # and keeps its process busy after the caller has given up on it
+    future.add_done_callback(_release)
+    try:
+        if in_greenlet():
+            # called from a route served through AsyncSession.run_sync, don't block the event loop
+            return await_only(asyncio.wait_for(asyncio.wrap_future(future), settings.BCRYPT_TIMEOUT))
+        return future.result(timeout=settings.BCRYPT_TIMEOUT)
+    except (TimeoutError, asyncio.TimeoutError):
+        future.cancel()
+        raise HTTPException(status_code=503, detail="Server is busy, try again later",
+                            headers={"Retry-After": "1"})
+
+
+def queue_depth() -> int:
+    """Number of hashing jobs currently waiting for or running in the pool."""
+    return _queued
+
+
+def shutdown_pool():
+    """Stop the hashing processes, dropping queued jobs; the next hash starts a new pool."""
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def hash_password(password: str) -> str:
+    return _run(_hash, password.encode('utf-8'), settings.BCRYPT_ROUNDS).decode('utf-8')
+
+
+def check_password(plain_password: str, hashed_password: str) -> bool:
+    return _run(_check, plain_password.encode('utf-8'), hashed_password.encode('utf-8'))
+
+
+def needs_rehash(hashed_password: str) -> bool:
+    """Whether the hash was made with a cost factor other than settings.BCRYPT_ROUNDS."""
+    try:
+        return int(hashed_password.split('$')[2]) != settings.BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
@@ -0,0 +1,167 @@
+from collections import Counter
+from threading import Event, Lock, Thread
+from typing import NamedTuple
+
+from sqlalchemy import bindparam, delete, tuple_, update
+
+from apps import global_logger
+from config import settings
+from database.models import Like, Post, counter_updates, insert_or_ignore
+
+
+class PendingLike(NamedTuple):
+    stored: bool
+    wanted: bool
+
+    @property
+    def delta(self) -> int:
+        """What writing this entry changes the like count by."""
+        if self.stored == self.wanted:
+            return 0
+        return 1 if self.wanted else -1
+
+
+class LikeBuffer:
+    """Write-behind buffer for likes and unlikes.
+
+    Only the last event per (user, post) is kept, along with whether that like is stored in
+    the database, so a like followed by an unlike cancels out before anything is written.
+    A background thread writes the buffer as bulk inserts and deletes every
+    LIKE_FLUSH_INTERVAL milliseconds, or as soon as LIKE_FLUSH_SIZE events are waiting.
+    ``like_count`` returns stored counts adjusted by the events that are not written yet.
+
+    The buffer lives in one process: with several workers, each one buffers its own events
+    and the others only see them once they are flushed.
+    """
+
+    def __init__(self, session_factory):
+        self.session_factory = session_factory
+        self._pending = {}
+        self._flushing = {}
+        self._deltas = Counter()
+        self._lock = Lock()
+        self._wakeup = Event()
+        self._stopped = Event()
+        self._thread = None
+
+    def like(self, user_id: int, post_id: int, db) -> bool:
+        return self._record(user_id, post_id, True, db)
+
+    def remove_like(self, user_id: int, post_id: int, db) -> bool:
+        return self._record(user_id, post_id, False, db)
+
+    def like_count(self, post_id: int, stored_count: int) -> int:
+        return stored_count + self._deltas.get(post_id, 0)
+
+    def pending(self) -> int:
+        return len(self._pending) + len(self._flushing)
+
+    def _record(self, user_id, post_id, wanted, db) -> bool:
+        """Buffer one event; False when it would not change anything, like ``User.like`` does."""
+        key = (user_id, post_id)
+        with self._lock:
+            known = self._pending.get(key) or self._flushing.get(key)
+        stored = known.wanted if known is not None else \
+            db.query(Like.id).filter(Like.user_id == user_id).filter(Like.post_id == post_id).first() is not None
+        with self._lock:
+            # the lookup above ran unlocked, another request for the same pair may have won
+            entry = self._pending.get(key)
+            if entry is not None:
+                current = entry.wanted
+            elif (flushing := self._flushing.get(key)) is not None:
+                current = flushing.wanted
+            else:
+                current = stored
+            if current == wanted:
+                return False
+            base = entry.stored if entry is not None else current
+            if base == wanted:
+                del self._pending[key]
+            else:
+                self._pending[key] = PendingLike(base, wanted)
+            self._deltas[post_id] += 1 if wanted else -1
+            waiting = len(self._pending)
+        self._start()
+        if waiting >= settings.LIKE_FLUSH_SIZE:
+            self._wakeup.set()
+        return True
+
+    def flush(self):
+        """Write everything buffered so far in one transaction."""
+        with self._lock:
+            if not self._pending or self._flushing:
+                return 0
+            self._flushing, self._pending = self._pending, {}
+        entries = self._flushing
+        db = self.session_factory()
+        try:
+            self._write(entries, db)
+            db.commit()
+        except Exception:
+            db.rollback()
+            global_logger.exception("Like buffer flush failed, %s events kept for the next one", len(entries))
+            with self._lock:
+                for key, entry in entries.items():
+                    if (newer := self._pending.get(key)) is not None:
+                        entry = PendingLike(entry.stored, newer.wanted)
+                    if entry.delta:
+                        self._pending[key] = entry
+                    else:
+                        # undone while the flush ran, like then unlike: nothing left to write
+                        self._pending.pop(key, None)
+                self._flushing = {}
+            return 0
+        finally:
+            db.close()
+        with self._lock:
+            for (_, post_id), entry in entries.items():
+                self._deltas[post_id] -= entry.delta
+                if not self._deltas[post_id]:
+                    del self._deltas[post_id]
+            self._flushing = {}
+        return len(entries)
+
+    def _write(self, entries, db):
+        likes = sorted(key for key, entry in entries.items() if entry.wanted)
+        unlikes = sorted(key for key, entry in entries.items() if not entry.wanted)
+        # count what was actually written, another process may have written the same rows
+        counts = Counter()
+        for start in range(0, len(likes), settings.LIKE_FLUSH_SIZE):
+            rows = [{"user_id": user_id, "post_id": post_id}
+                    for user_id, post_id in likes[start:start + settings.LIKE_FLUSH_SIZE]]
+            for post_id, in db.execute(insert_or_ignore(db, Like).values(rows).returning(Like.post_id)):
+                counts[post_id] += 1
+        for start in range(0, len(unlikes), settings.LIKE_FLUSH_SIZE):
+            pairs = unlikes[start:start + settings.LIKE_FLUSH_SIZE]
+            for post_id, in db.execute(delete(Like).
+                                       where(tuple_(Like.user_id, Like.post_id).in_(pairs)).
+                                       returning(Like.post_id)):
+                counts[post_id] -= 1
+        if changed := [{"post_id": post_id, "delta": delta} for post_id, delta in sorted(counts.items()) if delta]:
+            posts = Post.__table__
+            db.execute(update(posts).
+                       where(posts.c.id == bindparam("post_id")).
+                       values(counter_updates(likes=bindparam("delta"))), changed)
+
+    def _start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = Thread(target=self._run, name="like-buffer", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(settings.LIKE_FLUSH_INTERVAL / 1000)
+            self._wakeup.clear()
+            self.flush()
+
+    def stop(self):
+        """Stop the background thread and write what is left; the next event starts a new thread."""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._stopped.clear()
+        self.flush()
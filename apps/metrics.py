@@ -0,0 +1,227 @@
+from bisect import bisect_left
+from threading import Lock, current_thread, local
+import time
+
+from apps import global_logger, log_queue
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+WAIT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names, values, extra="") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Base for metrics whose values are kept in one shard per thread.
+
+    A thread only ever updates its own shard, so recording takes no lock; the lock is only
+    taken the first time a thread records something and when a scrape sums the shards.
+    Threads come and go with the threadpool, so a scrape folds the shards of threads that
+    have exited into a retired total and drops them.
+
+    Values are keyed by the tuple of label values, in the order of ``labels``. Metrics
+    given a ``callback`` are read from it when scraped instead; it returns a number, or a
+    dict of label value tuples to numbers.
+    """
+
+    type = None
+
+    def __init__(self, name: str, documentation: str, labels=(), callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.callback = callback
+        self._local = local()
+        self._shards = []
+        self._retired = {}
+        self._lock = Lock()
+
+    def _shard(self) -> dict:
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+            with self._lock:
+                self._shards.append((current_thread(), values))
+            return values
+
+    def _add(self, totals: dict, key, value):
+        # never updates a value in place, a snapshot may still be reading it
+        totals[key] = totals.get(key, 0) + value
+
+    def _snapshot(self):
+        with self._lock:
+            live = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live.append((thread, shard))
+                else:
+                    # nothing writes to the shard of an exited thread any more
+                    for key, value in shard.items():
+                        self._add(self._retired, key, value)
+            self._shards = live
+            shards = [self._retired, *(shard for _, shard in live)]
+            # copying a dict with plain keys is atomic under the GIL
+            return [dict(shard) for shard in shards]
+
+    def collect(self) -> dict:
+        if self.callback is not None:
+            value = self.callback()
+            return value if isinstance(value, dict) else {(): value}
+        totals = {}
+        for shard in self._snapshot():
+            for key, value in shard.items():
+                self._add(totals, key, value)
+        return totals
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        for key, value in sorted(self.collect().items()):
+            yield f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}"
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    """Observations counted into fixed buckets; ``buckets`` are the sorted upper bounds."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        shard = self._shard()
+        counts = shard.get(labels)
+        if counts is None:
+            # one count per bucket, one for +Inf, then the sum
+            counts = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _add(self, totals: dict, key, counts):
+        if key in totals:
+            totals[key] = [total + count for total, count in zip(totals[key], counts)]
+        else:
+            totals[key] = list(counts)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} {self.type}"
+        for key, counts in sorted(self.collect().items()):
+            cumulative = 0
+            for bound, count in zip((*self.buckets, float("inf")), counts):
+                cumulative += count
+                le = 'le="' + _format_value(bound) + '"'
+                yield f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labels, key)} {_format_value(counts[-1])}"
+            yield f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                # one broken callback should not take the whole scrape down
+                global_logger.exception("Collecting metric %s failed", metric.name)
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "http_requests_total", "HTTP requests by method, route template and status code.",
+    labels=("method", "route", "status")))
+http_request_duration = registry.register(Histogram(
+    "http_request_duration_seconds", "Time from receiving an HTTP request to sending its last byte.",
+    labels=("method", "route")))
+http_in_flight = registry.register(Gauge(
+    "http_requests_in_flight", "HTTP requests being served."))
+db_checkout_wait = registry.register(Histogram(
+    "db_pool_checkout_wait_seconds", "Time spent waiting for a connection from the pool.",
+    buckets=WAIT_BUCKETS))
+registry.register(Gauge(
+    "log_queue_size", "Log records waiting for the log listener thread.",
+    callback=log_queue.qsize))
+
+
+class MetricsMiddleware:
+    """Records the count and latency of every HTTP request.
+
+    Requests are labelled with the template of the route that served them, like
+    ``/posts/{post_id}``, so the number of series stays bounded; requests that matched no
+    route share the ``<unmatched>`` label.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        http_in_flight.inc()
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            http_in_flight.dec()
+            route = scope.get("route")
+            template = route.path if route is not None else "<unmatched>"
+            http_requests.inc(scope["method"], template, status)
+            http_request_duration.observe(elapsed, scope["method"], template)
@@ -0,0 +1,107 @@
+from collections import Counter
+from contextvars import ContextVar
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from apps import db_logger
+from config import settings
+
+
+class QueryStats:
+    """SQL statements run on behalf of one request."""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.statements = Counter()
+
+    def repeated(self):
+        """Statements run at least SQL_REPEAT_THRESHOLD times, the usual sign of an N+1 query."""
+        return {statement: count for statement, count in self.statements.items()
+                if count >= settings.SQL_REPEAT_THRESHOLD}
+
+
+current_stats: ContextVar[QueryStats | None] = ContextVar("current_stats", default=None)
+
+
+# the start time goes on the execution context, which lives for one statement; a failed
+# statement never reaches after_cursor_execute and is recorded by handle_error instead
+@event.listens_for(Engine, "before_cursor_execute")
+def start_timer(conn, cursor, statement, parameters, context, executemany):
+    if current_stats.get() is not None and context is not None:
+        context._query_started = time.perf_counter()
+
+
+def _record(context, statement):
+    if (stats := current_stats.get()) is not None and \
+            (started := getattr(context, "_query_started", None)) is not None:
+        stats.duration += time.perf_counter() - started
+        stats.count += 1
+        stats.statements[statement] += 1
+        del context._query_started
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def record_statement(conn, cursor, statement, parameters, context, executemany):
+    _record(context, statement)
+
+
+@event.listens_for(Engine, "handle_error")
+def record_failed_statement(exception_context):
+    _record(exception_context.execution_context, exception_context.statement)
+
+
+def server_timing_queries(header: str) -> int:
+    """The statement count a ``Server-Timing`` header written by QueryStatsMiddleware reports."""
+    for metric in header.split(","):
+        name, *params = (part.strip() for part in metric.split(";"))
+        if name == "db":
+            for param in params:
+                if param.startswith("desc="):
+                    return int(param[len("desc="):].strip('"').split()[0])
+    raise ValueError(f"No db metric in Server-Timing: {header!r}")
+
+
+class QueryStatsMiddleware:
+    """Counts the SQL of every HTTP request and reports it in a ``Server-Timing`` header.
+
+    The stats live in a context variable, which Starlette copies into the threadpool that
+    runs sync endpoints and which ``AsyncSession.run_sync`` keeps, so statements are
+    attributed to the request that issued them whichever way it is served. The header goes
+    out with the response start, so statements behind a streamed body only show up in the
+    log line.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        stats = QueryStats()
+        token = current_stats.set(stats)
+        started = time.perf_counter()
+        status = None
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timing = f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries", ' \
+                         f'total;dur={(time.perf_counter() - started) * 1000:.1f}'
+                message["headers"] = [*message.get("headers", []), (b"server-timing", timing.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            current_stats.reset(token)
+            if repeated := stats.repeated():
+                db_logger.warning("Repeated statements: method=%s, path=%s, statements=%s",
+                                  scope["method"], scope["path"],
+                                  [f"{count}x {' '.join(statement.split())[:120]}" for statement, count in repeated.items()])
+            if settings.SQL_LOG_REQUESTS:
+                db_logger.info("Request queries: method=%s, path=%s, status=%s, queries=%s, db_ms=%.1f",
+                               scope["method"], scope["path"], status, stats.count, stats.duration * 1000)
@@ -0,0 +1,176 @@
+from collections import OrderedDict
+from math import ceil
+from threading import Lock, local
+import sqlite3
+import time
+
+from fastapi import HTTPException, Request
+from starlette.concurrency import run_in_threadpool
+
+from apps import auth_logger
+from apps.metrics import Counter, registry
+from config import settings
+
+rate_limited = registry.register(Counter(
+    "auth_rate_limited_total", "Authentication attempts rejected by the rate limiter.",
+    labels=("endpoint", "key")))
+
+
+def _refill(tokens, updated, now, rate, burst):
+    """The bucket's tokens at ``now`` and how long until it has one, 0 if it has one already."""
+    tokens = min(burst, tokens + (now - updated) * rate)
+    return tokens, max(0.0, (1 - tokens) / rate)
+
+
+class MemoryStore:
+    """Token buckets in this process, at most ``maxsize`` of them.
+
+    The least recently used bucket is dropped to make room, which is the same as it
+    refilling early; a client would need ``maxsize`` other keys in flight to benefit.
+    """
+
+    blocking = False
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = Lock()
+
+    def take(self, buckets, now: float) -> list[float]:
+        """Spend a token from every (key, rate, burst) bucket if all have one; the wait for each."""
+        with self._lock:
+            refilled = [_refill(*self._buckets.pop(key, (burst, now)), now, rate, burst)
+                        for key, rate, burst in buckets]
+            spend = not any(wait for _, wait in refilled)
+            for (key, _, _), (tokens, _) in zip(buckets, refilled):
+                self._buckets[key] = (tokens - 1 if spend else tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return [wait for _, wait in refilled]
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class SQLiteStore:
+    """Token buckets in a SQLite file, shared by every worker that opens the same path.
+
+    Each take runs in its own ``BEGIN IMMEDIATE`` transaction, so concurrent workers see
+    each other's updates. Buckets are deleted once they would be full again; ``maxsize``
+    only bounds how many may be kept before that.
+    """
+
+    blocking = True
+
+    def __init__(self, path: str, maxsize: int):
+        self.path = path
+        self.maxsize = maxsize
+        self._local = local()
+        self._takes = 0
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS rate_limits "
+                               "(key TEXT PRIMARY KEY, tokens REAL, updated REAL, full_at REAL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS ix_rate_limits_full_at ON rate_limits (full_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.connection = connection
+        return connection
+
+    def take(self, buckets, now: float) -> list[float]:
+        """Spend a token from every (key, rate, burst) bucket if all have one; the wait for each."""
+        connection = self._connect()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            refilled = []
+            for key, rate, burst in buckets:
+                row = connection.execute("SELECT tokens, updated FROM rate_limits WHERE key = ?", (key,)).fetchone()
+                refilled.append(_refill(*(row or (burst, now)), now, rate, burst))
+            spend = not any(wait for _, wait in refilled)
+            for (key, rate, burst), (tokens, _) in zip(buckets, refilled):
+                tokens = tokens - 1 if spend else tokens
+                connection.execute("INSERT OR REPLACE INTO rate_limits (key, tokens, updated, full_at) "
+                                   "VALUES (?, ?, ?, ?)", (key, tokens, now, now + (burst - tokens) / rate))
+            self._takes += 1
+            if self._takes % 1000 == 0:
+                self._prune(connection, now)
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return [wait for _, wait in refilled]
+
+    def _prune(self, connection, now):
+        connection.execute("DELETE FROM rate_limits WHERE full_at <= ?", (now,))
+        connection.execute("DELETE FROM rate_limits WHERE key IN "
+                           "(SELECT key FROM rate_limits ORDER BY updated DESC LIMIT -1 OFFSET ?)", (self.maxsize,))
+
+
+def create_store(path: str = settings.RATE_LIMIT_STORE):
+    if path:
+        return SQLiteStore(path, settings.RATE_LIMIT_MAX_KEYS)
+    return MemoryStore(settings.RATE_LIMIT_MAX_KEYS)
+
+
+class RateLimiter:
+    """Token buckets for one endpoint, one per client IP and one per username.
+
+    Rates are attempts per minute; ``burst`` attempts may be made at once before the rate
+    applies. An attempt goes ahead only when both of its buckets have a token, and only
+    then are the tokens spent: an attempt turned away for its username leaves the client's
+    IP allowance alone.
+    """
+
+    def __init__(self, endpoint: str, store, ip_rate: float, ip_burst: int,
+                 username_rate: float, username_burst: int):
+        self.endpoint = endpoint
+        self.store = store
+        self.limits = {"ip": (ip_rate / 60, ip_burst), "username": (username_rate / 60, username_burst)}
+
+    def take(self, ip: str | None, username: str | None, now: float | None = None) -> tuple[str, float] | None:
+        """Spend a token from each bucket; or the first bucket that is empty and how long until it is not."""
+        now = time.time() if now is None else now
+        kinds = [(kind, value) for kind, value in (("ip", ip), ("username", username)) if value is not None]
+        if not kinds:
+            return None
+        waits = self.store.take([(f"{self.endpoint}:{kind}:{value}", *self.limits[kind]) for kind, value in kinds], now)
+        for (kind, _), wait in zip(kinds, waits):
+            if wait:
+                return kind, wait
+        return None
+
+    async def __call__(self, request: Request):
+        if not settings.AUTH_RATE_LIMIT:
+            return
+        try:
+            # the body is cached on the request, the endpoint parses it again without reading it twice
+            username = (await request.json()).get("username")
+        except (ValueError, AttributeError):
+            username = None
+        ip = request.client.host if request.client else None
+        username = username.lower() if isinstance(username, str) else None
+        if self.store.blocking:
+            limited = await run_in_threadpool(self.take, ip, username)
+        else:
+            limited = self.take(ip, username)
+        if limited is not None:
+            kind, wait = limited
+            rate_limited.inc(self.endpoint, kind)
+            auth_logger.warning("Too many %s attempts: ip=%s, username=%s, limited_by=%s",
+                                self.endpoint, ip, username, kind)
+            raise HTTPException(status_code=429, detail="Too many attempts, try again later",
+                                headers={"Retry-After": str(ceil(wait))})
+
+
+store = create_store()
+
+login_limiter = RateLimiter("login", store,
+                            settings.AUTH_IP_RATE, settings.AUTH_IP_BURST,
+                            settings.AUTH_USERNAME_RATE, settings.AUTH_USERNAME_BURST)
+register_limiter = RateLimiter("register", store,
+                               settings.AUTH_IP_RATE, settings.AUTH_IP_BURST,
+                               settings.AUTH_USERNAME_RATE, settings.AUTH_USERNAME_BURST)
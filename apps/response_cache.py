@@ -0,0 +1,134 @@
+from collections import OrderedDict
+from hashlib import blake2b
+from threading import Lock
+
+import orjson
+from fastapi import Request, Response
+
+from config import settings
+
+
+class ResponseCache:
+    """LRU cache of rendered JSON bodies bounded by their total size.
+
+    Every entry carries tags naming what it was built from (``post:<id>`` for each post in
+    the body, ``posts:all`` for listing pages) and writes drop exactly the entries tagged
+    with what they touched. Each invalidation bumps ``generation``, so a response that was
+    being built while the data changed is not stored.
+    """
+
+    def __init__(self, maxbytes: int):
+        self.maxbytes = maxbytes
+        self.size = 0
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._tagged = {}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry
+
+    def set(self, key, body: bytes, etag: str, tags, generation: int):
+        if len(body) > self.maxbytes:
+            return
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._remove(key)
+            self._entries[key] = (body, etag, tags)
+            self.size += len(body)
+            for tag in tags:
+                self._tagged.setdefault(tag, set()).add(key)
+            while self.size > self.maxbytes:
+                self._remove(next(iter(self._entries)))
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+    def invalidate(self, *tags):
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in self._tagged.pop(tag, ()):
+                    self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._tagged.clear()
+            self.size = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        body, _, tags = entry
+        self.size -= len(body)
+        for tag in tags:
+            if keys := self._tagged.get(tag):
+                keys.discard(key)
+                if not keys:
+                    del self._tagged[tag]
+
+
+response_cache = ResponseCache(settings.RESPONSE_CACHE_BYTES)
+
+
+def post_tags(*post_ids):
+    return [f"post:{post_id}" for post_id in post_ids]
+
+
+def _tags_of(content, tags):
+    if isinstance(content, dict):
+        if 'id' in content:
+            tags.add(f"post:{content['id']}")
+        for value in content.values():
+            _tags_of(value, tags)
+    elif isinstance(content, list):
+        for value in content:
+            _tags_of(value, tags)
+    return tags
+
+
+def _cache_key(request: Request):
+    return request.url.path, tuple(sorted(request.query_params.multi_items()))
+
+
+def _respond(request: Request, body: bytes, etag: str) -> Response:
+    if_none_match = request.headers.get("if-none-match", "")
+    if etag in (tag.strip() for tag in if_none_match.split(",")) or if_none_match.strip() == "*":
+        return Response(status_code=304, headers={"ETag": etag})
+    return Response(content=body, media_type="application/json", headers={"ETag": etag})
+
+
+def cached_response(request: Request) -> Response | None:
+    """Serve a read from the cache, answering 304 when the client already has it.
+
+    Remembers the cache generation on the request so ``cache_response`` can tell
+    whether the data changed while the response was built.
+    """
+    request.state.cache_generation = response_cache.generation
+    entry = response_cache.get(_cache_key(request))
+    if entry is None:
+        return None
+    body, etag, _ = entry
+    return _respond(request, body, etag)
+
+
+def cache_response(request: Request, content, *tags) -> Response:
+    """Render ``content``, store it tagged with every post it contains plus ``tags`` and respond."""
+    body = orjson.dumps(content)
+    etag = f'"{blake2b(body, digest_size=16).hexdigest()}"'
+    response_cache.set(_cache_key(request), body, etag, frozenset(_tags_of(content, set(tags))),
+                       request.state.cache_generation)
+    return _respond(request, body, etag)
@@ -1,11 +1,10 @@
-from starlette.middleware.cors import CORSMiddleware
-
-from apps import app
-from config import settings
-
-from fastapi import APIRouter, Depends, Request, HTTPException
-from fastapi.responses import JSONResponse
-from apps.dependencies import check_auth, check_admin, get_current_user
+from fastapi import APIRouter, Depends, Request, HTTPException, params
+from fastapi.responses import JSONResponse, Response
+from apps.metrics import CONTENT_TYPE, registry
+from apps.dependencies import check_auth, check_admin, get_current_user, get_db, get_async_db, decode_token
+from sqlalchemy.ext.asyncio import AsyncSession
+from functools import wraps
+import inspect
 import jwt
 
 guest_router = APIRouter()
@@ -17,12 +16,84 @@ def home_get(request: Request):
     return JSONResponse(status_code=200, content={"message": "Hello world!",
                                                   "user": get_current_user(request)})
 
+@guest_router.get('/metrics', include_in_schema=False)
+async def metrics_get():
+    return Response(content=registry.render(), media_type=CONTENT_TYPE)
+
+def uses_db(call) -> bool:
+    """Whether ``call`` depends on ``get_db``, directly or through its own dependencies."""
+    for parameter in inspect.signature(call).parameters.values():
+        if isinstance(parameter.default, params.Depends) and \
+                (parameter.default.dependency is get_db or uses_db(parameter.default.dependency)):
+            return True
+    return False
+
+_async_versions = {}
+
+def run_in_async_session(call):
+    """Build the ``async def`` version of a sync endpoint or dependency.
+
+    The ``get_db`` session is swapped for an ``AsyncSession`` and the original body runs
+    through ``AsyncSession.run_sync``, so its queries await the async driver on the event
+    loop instead of occupying a threadpool thread. Dependencies that need the database are
+    converted the same way; the results are memoized so FastAPI still resolves each of
+    them once per request.
+    """
+    if call in _async_versions:
+        return _async_versions[call]
+
+    db_parameter = None
+    parameters = []
+    for parameter in inspect.signature(call).parameters.values():
+        dependency = parameter.default
+        if isinstance(dependency, params.Depends):
+            if dependency.dependency is get_db:
+                db_parameter = parameter.name
+                parameter = parameter.replace(default=Depends(get_async_db), annotation=AsyncSession)
+            elif uses_db(dependency.dependency):
+                parameter = parameter.replace(default=Depends(run_in_async_session(dependency.dependency),
+                                                              use_cache=dependency.use_cache))
+        parameters.append(parameter)
+
+    if db_parameter is None:
+        @wraps(call)
+        def async_version(**kwargs):
+            return call(**kwargs)
+    else:
+        @wraps(call)
+        async def async_version(**kwargs):
+            db = kwargs.pop(db_parameter)
+            return await db.run_sync(lambda session: call(**kwargs, **{db_parameter: session}))
+
+    async_version.__signature__ = inspect.signature(call).replace(parameters=parameters)
+    _async_versions[call] = async_version
+    return async_version
+
+def asyncify_router(router: APIRouter) -> APIRouter:
+    """Copy a router, serving every route that touches the database through ``run_in_async_session``."""
+    async_router = APIRouter(dependencies=[
+        Depends(run_in_async_session(dependency.dependency), use_cache=dependency.use_cache)
+        if uses_db(dependency.dependency) else dependency
+        for dependency in router.dependencies
+    ])
+    for route in router.routes:
+        async_router.add_api_route(
+            route.path,
+            run_in_async_session(route.endpoint) if uses_db(route.endpoint) else route.endpoint,
+            methods=list(route.methods),
+            name=route.name,
+            response_model=route.response_model,
+            status_code=route.status_code,
+            response_class=route.response_class,
+        )
+    return async_router
+
 async def verify_token(request: Request, call_next):
     token = request.cookies.get("access_token")
 
     if token:
         try:
-            payload = jwt.decode(token, settings.SECRET_KEY, algorithms=[settings.ALGORITHM])
+            payload = decode_token(token)
             request.state.user = payload
         except jwt.DecodeError:
             request.state.user = None
@@ -36,13 +107,3 @@ async def verify_token(request: Request, call_next):
         request.state.user = None
     response = await call_next(request)
     return response
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
-
-app.middleware("http")(verify_token)
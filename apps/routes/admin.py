@@ -1,8 +1,12 @@
 from . import admin_router
-from apps.dependencies import SessionLocal, get_db
+from apps.dependencies import SessionLocal, get_db, profile_cache
+from apps.response_cache import response_cache, post_tags
+from apps.export import stream_posts_export
+from apps.search import unindex_post
 from fastapi import Depends, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from database.models import Post
+from datetime import datetime
 
 @admin_router.put('/admin/hide-post/{post_id}')
 def hide_post_get(post_id: int,
@@ -10,7 +14,25 @@ def hide_post_get(post_id: int,
     post = db.query(Post).filter(Post.id == post_id).first()
     if not post:
         raise HTTPException(status_code=404, detail="No such post")
-    if post.user.role == 2:
+    if post.user.role_id == 2:
         raise HTTPException(status_code=403, detail="Author is admin")
     post.hide()
-    return JSONResponse(status_code=200, content={"message": "Successful"})
+    unindex_post(post, db)
+    db.commit()
+    response_cache.invalidate(*post_tags(post_id, *([post.refer_to] if post.refer_to else [])),
+                              *(["posts:all"] if post.type == 1 else []))
+    profile_cache.pop(post.user_id)
+    return ORJSONResponse(status_code=200, content={"message": "Successful"})
+
+@admin_router.get('/admin/export/posts')
+def export_posts_get(user_id: int | None = None,
+                     since: datetime | None = None,
+                     until: datetime | None = None,
+                     include_hidden: bool = False,
+                     include_comments: bool = False):
+    if since and until and since >= until:
+        raise HTTPException(status_code=400, detail="Empty date range")
+    return StreamingResponse(stream_posts_export(user_id=user_id, since=since, until=until,
+                                                 include_hidden=include_hidden,
+                                                 include_comments=include_comments),
+                             media_type="application/x-ndjson")
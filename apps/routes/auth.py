@@ -1,20 +1,27 @@
 from apps import auth_logger
-from starlette.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 from . import guest_router, secure_router
+from apps.rate_limit import login_limiter, register_limiter
 from apps.schemas import UserCreate
-from apps.dependencies import SessionLocal, get_db, hash_password, create_access_token, check_password
+from apps.dependencies import SessionLocal, get_db, hash_password, create_access_token, check_password, \
+    needs_rehash
 from database.models import User
 from fastapi import Depends, HTTPException, Request
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 
 @guest_router.post('/auth/register')
 def auth_register_post(user: UserCreate,
+                       rate_limit: None = Depends(register_limiter),
                        db: SessionLocal = Depends(get_db)):
-    auth_logger.info(f"Registration attempt: {user.username} - {user.email}")
-    if db.query(User).filter(User.username == user.username).first():
-        auth_logger.warning(f"Username already registered: {user.username}")
-        raise HTTPException(status_code=400, detail="Username already registered")
-    if db.query(User).filter(User.email == user.email).first():
-        auth_logger.warning(f"Email already registered: {user.email}")
+    auth_logger.info("Registration attempt: %s - %s", user.username, user.email)
+    if taken := db.query(User.username). \
+            filter(or_(User.username == user.username, User.email == user.email)). \
+            first():
+        if taken.username == user.username:
+            auth_logger.warning("Username already registered: %s", user.username)
+            raise HTTPException(status_code=400, detail="Username already registered")
+        auth_logger.warning("Email already registered: %s", user.email)
         raise HTTPException(status_code=400, detail="Email already registered")
     db_user = User(
         username=user.username,
@@ -22,41 +29,52 @@ def auth_register_post(user: UserCreate,
         hashed_password=hash_password(user.password)
     )
     db.add(db_user)
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        # registered concurrently between the check and the insert
+        db.rollback()
+        auth_logger.warning("Username or email already registered: %s - %s", user.username, user.email)
+        raise HTTPException(status_code=400, detail="Username or email already registered")
     db.refresh(db_user)
 
     access_token = create_access_token(
-        data={"sub": user.username}
+        data={"sub": db_user.username, "uid": db_user.id, "role": db_user.role_id}
     )
 
-    server_response = JSONResponse(status_code=200, content={"message": "Successful"})
+    server_response = ORJSONResponse(status_code=200, content={"message": "Successful"})
     server_response.set_cookie(key="access_token", value=access_token, httponly=True, secure=True)
 
     return server_response
 
 @guest_router.post('/auth/login')
 def auth_login_post(user: UserCreate,
+                    rate_limit: None = Depends(login_limiter),
                     db: SessionLocal = Depends(get_db)):
-    auth_logger.info(f"Login attempt: {user.username} - {user.email}")
-    if not db.query(User).filter(User.username == user.username).first() or not db.query(User).filter(User.email == user.email).first():
-        auth_logger.warning(f"Invalid credentials: {user.username} - {user.email}")
+    auth_logger.info("Login attempt: %s - %s", user.username, user.email)
+    db_user = db.query(User).filter(User.username == user.username).first()
+    if not db_user or db_user.email != user.email:
+        auth_logger.warning("Invalid credentials: %s - %s", user.username, user.email)
         raise HTTPException(status_code=400, detail="Username or email does not exist")
-    if not check_password(user.password, db.query(User).filter(User.username == user.username).first().hashed_password):
-        auth_logger.warning(f"Invalid password: {user.username}")
+    if not check_password(user.password, db_user.hashed_password):
+        auth_logger.warning("Invalid password: %s", user.username)
         raise HTTPException(status_code=400, detail="Password is incorrect")
+    if needs_rehash(db_user.hashed_password):
+        db_user.hashed_password = hash_password(user.password)
+        db.commit()
     access_token = create_access_token(
-        data={"sub": user.username}
+        data={"sub": db_user.username, "uid": db_user.id, "role": db_user.role_id}
     )
 
-    server_response = JSONResponse(status_code=200, content={"message": "Successful"})
+    server_response = ORJSONResponse(status_code=200, content={"message": "Successful"})
     server_response.set_cookie(key="access_token", value=access_token, httponly=True, secure=True)
 
     return server_response
 
 @secure_router.get('/auth/logout')
 def auth_logout_get(request: Request):
-    auth_logger.info(f"Logout attempt - {request.state.user.get('sub')}")
+    auth_logger.info("Logout attempt - %s", request.state.user.get('sub'))
     request.state.user = None
-    server_response = JSONResponse(status_code=200, content={"message": "Successful"})
+    server_response = ORJSONResponse(status_code=200, content={"message": "Successful"})
     server_response.set_cookie(key="access_token", value="", httponly=True, secure=True)
     return server_response
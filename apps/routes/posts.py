@@ -1,216 +1,390 @@
-from apps import posts_logger
+from apps import posts_logger, posts_read_logger
 from . import secure_router, guest_router
-from apps.schemas import PostCreate
-from apps.dependencies import SessionLocal, get_db, get_comments
-from database.models import User, Post, Like, Followers
+from apps.schemas import PostCreate, PostDetailOut, PostPageOut, PostCursorPageOut, SearchPageOut, PostBulkCreate, \
+    BulkIds, BulkResultsOut, RepliesPageOut
+from apps.dependencies import SessionLocal, get_db, get_comments, posts_to_json, Identity, get_identity, \
+    paginate_posts_by_page, paginate_posts_by_cursor, like_buffer, profile_cache, CommentLimits, comment_limits, \
+    mark_truncated, get_replies, paginate_posts_by_score
+from apps.response_cache import cached_response, cache_response, response_cache, post_tags
+from apps.search import index_post, index_posts, unindex_post, search_posts, search_results_to_json
+from apps.timeline import fan_out_post, fan_out_posts, timeline_page
 from config import settings
+from database.models import User, Post, counter_updates
+from fastapi import Request, Depends, HTTPException, Query
+from fastapi.responses import ORJSONResponse
 
-from fastapi import Request, Depends, HTTPException
-from fastapi.responses import JSONResponse
+from datetime import datetime, timedelta
+from typing import Literal
 
-from sqlalchemy import func
+from sqlalchemy import insert
+from sqlalchemy.orm import joinedload
+
+
+def reader(request: Request):
+    return 'guest' if request.state.user is None else request.state.user.get('sub')
 
 
 @secure_router.post('/posts/create')
 def messages_post(request: Request,
                   post: PostCreate,
+                  user: Identity = Depends(get_identity),
                   db: SessionLocal = Depends(get_db)):
-    user = db.query(User).filter(User.username == request.state.user.get("sub")).first()
     posts_logger.info(
-        f"Post adding attempt by user: user={user.username}")
+        "Post adding attempt by user: user=%s", user.username)
     db_post = Post(
         title=post.title,
         content=post.content,
         user_id=user.id
     )
     db.add(db_post)
+    db.flush()
+    fan_out_post(db_post, db)
+    index_post(db_post, db)
     db.commit()
+    response_cache.invalidate("posts:all")
+    profile_cache.pop(user.id)
     db.refresh(db_post)
     posts_logger.info(
-        f"Post added successfully by user: user={user.username}, post_id={db_post.id}")
-    return JSONResponse(status_code=200, content={"message": "Post published"})
+        "Post added successfully by user: user=%s, post_id=%s", user.username, db_post.id)
+    return ORJSONResponse(status_code=200, content={"message": "Post published"})
+
+
+@secure_router.post('/posts/bulk/create', response_model=BulkResultsOut)
+def messages_bulk_post(request: Request,
+                       body: PostBulkCreate,
+                       user: Identity = Depends(get_identity),
+                       db: SessionLocal = Depends(get_db)):
+    posts_logger.info(
+        "Bulk post adding attempt by user: user=%s, posts=%s", user.username, len(body.posts))
+    rows = [{"title": post.title, "content": post.content, "user_id": user.id} for post in body.posts]
+    # one multi-row INSERT, ids come back in insertion order
+    created = sorted(db.execute(insert(Post).returning(Post.id, Post.title, Post.content), rows))
+    post_ids = [post.id for post in created]
+    fan_out_posts(user.id, post_ids, db)
+    index_posts([post._asdict() for post in created], db)
+    db.commit()
+    response_cache.invalidate("posts:all")
+    profile_cache.pop(user.id)
+    posts_logger.info(
+        "Bulk posts added successfully by user: user=%s, posts=%s", user.username, len(post_ids))
+    return ORJSONResponse(content={"results": [{"id": post_id, "result": "created"} for post_id in post_ids]})
 
 
 @secure_router.put('/posts/remove/{post_id:int}')
 def message_delete_get(request: Request,
                        post_id: int,
+                       user: Identity = Depends(get_identity),
                        db: SessionLocal = Depends(get_db)):
-    user = db.query(User).filter(User.username == request.state.user.get("sub")).first()
     posts_logger.info(
-        f"Post delete attempt by user: user={user.username}, post_id={post_id}")
+        "Post delete attempt by user: user=%s, post_id=%s", user.username, post_id)
     post = db.query(Post).filter(Post.id == post_id).first()
     if not post:
         posts_logger.warning(
-            f"Post does not exist occurred: user={user.username}, endpoint=/posts/remove/{post_id}")
+            "Post does not exist occurred: user=%s, endpoint=/posts/remove/%s", user.username, post_id)
         raise HTTPException(status_code=404, detail="This post does not exist")
     if post.user_id != user.id:
         posts_logger.warning(
-            f"Unowned post exc occurred: user={user.username}, endpoint=/posts/remove/{post_id}")
+            "Unowned post exc occurred: user=%s, endpoint=/posts/remove/%s", user.username, post_id)
         raise HTTPException(status_code=403, detail="You do not own this post")
     post.hide()
+    unindex_post(post, db)
     posts_logger.info(
-        f"Post hidden successfully by user: user={user.username}, post_id={post_id}")
+        "Post hidden successfully by user: user=%s, post_id=%s", user.username, post_id)
     db.commit()
-    return JSONResponse(status_code=200, content={"message": "Post hidden"})
+    # the parent's reply_count changes even where the hidden reply itself was cut from a tree
+    response_cache.invalidate(*post_tags(post_id, *([post.refer_to] if post.refer_to else [])),
+                              *(["posts:all"] if post.type == 1 else []))
+    profile_cache.pop(post.user_id)
+    return ORJSONResponse(status_code=200, content={"message": "Post hidden"})
 
-@guest_router.get('/posts/{post_id:int}')
+@guest_router.get('/posts/{post_id:int}', response_model=PostDetailOut)
 def message_get(request: Request,
                 post_id: int,
+                limits: CommentLimits = Depends(comment_limits),
                 db: SessionLocal = Depends(get_db)):
-    posts_logger.info(
-        f"Message read attempt: user={'guest' if not hasattr(request.state, 'user') else request.state.user.get('sub')}")
+    posts_read_logger.info(
+        "Message read attempt: user=%s", reader(request))
+    if cached := cached_response(request):
+        return cached
     post = db.query(Post).filter(Post.id == post_id).filter(Post.hidden == bool(0)).first()
     if not post:
         posts_logger.warning(
-            f"Post does not exist occurred: user={'guest' if request.state.user is None else request.state.user.get('sub')}, endpoint=/posts/{post_id}")
+            "Post does not exist occurred: user=%s, endpoint=/posts/%s", reader(request), post_id)
         raise HTTPException(status_code=404, detail="This post does not exist")
     post_json = {
         'id': post.id,
         'title': post.title,
         'content': post.content,
         'user': post.user.username,
-        'date': str(post.created_at),
-        'likes': db.query(func.count(Like.post_id)).filter(Like.post_id == post.id).scalar()}
+        'date': post.created_at,
+        'likes': like_buffer.like_count(post.id, post.like_count)}
+    replies = get_comments(post_id, db, limits)
     if post.type == 2:
         post_json['comment_for'] = post.refer_to
-        post_json['answers'] = get_comments(post_id, db)
+        post_json['answers'] = replies
     elif post.type == 3:
         post_json['answer_for'] = post.refer_to
-        post_json['answers'] = get_comments(post_id, db)
+        post_json['answers'] = replies
     else:
-        post_json['comments'] = get_comments(post_id, db)
+        post_json['comments'] = replies
+    mark_truncated(post_json, replies, post.comment_count)
     db.close()
-    posts_logger.info(
-        f"Post read successfully by user: {'guest' if request.state.user is None else request.state.user.get('sub')}, post={post_id}")
-    return JSONResponse(content={"data": post_json})
+    posts_read_logger.info(
+        "Post read successfully by user: %s, post=%s", reader(request), post_id)
+    return cache_response(request, {"data": post_json})
+
+
+@guest_router.get('/posts/{post_id:int}/replies', response_model=RepliesPageOut)
+def replies_get(request: Request,
+                post_id: int,
+                after: str | None = None,
+                limits: CommentLimits = Depends(comment_limits),
+                db: SessionLocal = Depends(get_db)):
+    posts_read_logger.info(
+        "Replies read attempt: user=%s, post=%s", reader(request), post_id)
+    if cached := cached_response(request):
+        return cached
+    if not db.query(Post.id).filter(Post.id == post_id).filter(Post.hidden == bool(0)).first():
+        posts_logger.warning(
+            "Post does not exist occurred: user=%s, endpoint=/posts/%s/replies", reader(request), post_id)
+        raise HTTPException(status_code=404, detail="This post does not exist")
+    replies, next_cursor = get_replies(post_id, db, limits, after)
+    db.close()
+    return cache_response(request, {"data": replies, "next_cursor": next_cursor}, *post_tags(post_id))
 
 
-@guest_router.get('/posts/all/{page:int}')
+def all_posts_query(db):
+    return db.query(Post). \
+        options(joinedload(Post.user)). \
+        filter(Post.hidden == bool(0)). \
+        filter(Post.type == 1)
+
+
+@guest_router.get('/posts/all/{page:int}', response_model=PostPageOut)
 def messages_get(request: Request,
                  page: int,
+                 limits: CommentLimits = Depends(comment_limits),
                  db: SessionLocal = Depends(get_db)):
-    posts_logger.info(
-        f"Messages read attempt by user: user={'guest' if request.state.user is None else request.state.user.get('sub')}")
-    posts = db.query(Post). \
-        filter(Post.hidden == bool(0)). \
-        filter(Post.type == 1). \
-        offset((page - 1) * settings.POSTS_PER_PAGE). \
-        limit(settings.POSTS_PER_PAGE).all()
+    posts_read_logger.info(
+        "Messages read attempt by user: user=%s", reader(request))
+    if cached := cached_response(request):
+        return cached
+    posts = paginate_posts_by_page(all_posts_query(db), page)
     if not posts:
         posts_logger.warning(
-            f"Page does not exist occurred: user={'guest' if request.state.user is None else request.state.user.get('sub')}, endpoint=/posts/all/{page}")
+            "Page does not exist occurred: user=%s, endpoint=/posts/all/%s", reader(request), page)
         raise HTTPException(status_code=404, detail="No such page")
-    posts_json = [{'id': post.id,
-                   'title': post.title,
-                   'content': post.content,
-                   'user': post.user.username,
-                   'date': str(post.created_at),
-                   'likes': db.query(func.count(Like.post_id)).filter(Like.post_id == post.id).scalar(),
-                   'comments': get_comments(post.id, db)}
-                  for post in posts]
+    posts_json = posts_to_json(posts, db, limits)
     db.close()
-    posts_logger.info(
-        f"Messages read successfully by user: user={'guest' if request.state.user is None else request.state.user.get('sub')}, posts={[post.id for post in posts]}")
-    return JSONResponse(content={"data": posts_json})
+    posts_read_logger.info(
+        "Messages read successfully by user: user=%s, posts=%s", reader(request), [post.id for post in posts])
+    return cache_response(request, {"data": posts_json}, "posts:all")
+
+
+@guest_router.get('/posts/all', response_model=PostCursorPageOut)
+def messages_cursor_get(request: Request,
+                        after: str | None = None,
+                        limits: CommentLimits = Depends(comment_limits),
+                        db: SessionLocal = Depends(get_db)):
+    posts_read_logger.info(
+        "Messages read attempt by user: user=%s", reader(request))
+    if cached := cached_response(request):
+        return cached
+    posts, next_cursor = paginate_posts_by_cursor(all_posts_query(db), after)
+    posts_json = posts_to_json(posts, db, limits)
+    db.close()
+    posts_read_logger.info(
+        "Messages read successfully by user: user=%s, posts=%s", reader(request), [post.id for post in posts])
+    return cache_response(request, {"data": posts_json, "next_cursor": next_cursor}, "posts:all")
+
+
+@guest_router.get('/posts/hot', response_model=PostCursorPageOut)
+def hot_posts_get(request: Request,
+                  after: str | None = None,
+                  limits: CommentLimits = Depends(comment_limits),
+                  db: SessionLocal = Depends(get_db)):
+    posts_read_logger.info(
+        "Hot messages read attempt by user: user=%s", reader(request))
+    posts, next_cursor = paginate_posts_by_score(all_posts_query(db), Post.hot_score, after)
+    posts_json = posts_to_json(posts, db, limits)
+    db.close()
+    return ORJSONResponse(content={"data": posts_json, "next_cursor": next_cursor})
+
+
+TOP_WINDOWS = {"day": timedelta(days=1), "week": timedelta(weeks=1), "month": timedelta(days=30),
+               "year": timedelta(days=365), "all": None}
+
+
+@guest_router.get('/posts/top', response_model=PostCursorPageOut)
+def top_posts_get(request: Request,
+                  window: Literal["day", "week", "month", "year", "all"] = "week",
+                  after: str | None = None,
+                  limits: CommentLimits = Depends(comment_limits),
+                  db: SessionLocal = Depends(get_db)):
+    posts_read_logger.info(
+        "Top messages read attempt by user: user=%s, window=%s", reader(request), window)
+    posts_query = all_posts_query(db)
+    if TOP_WINDOWS[window] is not None:
+        posts_query = posts_query.filter(Post.created_at >= datetime.utcnow() - TOP_WINDOWS[window])
+    posts, next_cursor = paginate_posts_by_score(posts_query, Post.top_score, after)
+    posts_json = posts_to_json(posts, db, limits)
+    db.close()
+    return ORJSONResponse(content={"data": posts_json, "next_cursor": next_cursor})
+
 
+@guest_router.get('/posts/search', response_model=SearchPageOut)
+def posts_search_get(request: Request,
+                     q: str = Query(min_length=1, max_length=200),
+                     after: str | None = None,
+                     db: SessionLocal = Depends(get_db)):
+    posts_read_logger.info(
+        "Posts search by user: user=%s, q=%r", reader(request), q)
+    posts, next_cursor = search_posts(db, q, after)
+    posts_json = search_results_to_json(posts)
+    db.close()
+    return ORJSONResponse(content={"data": posts_json, "next_cursor": next_cursor})
 
-@secure_router.get('/posts/followed/{page:int}')
+
+@secure_router.get('/posts/followed/{page:int}', response_model=PostPageOut)
 def followed_posts_get(request: Request,
                        page: int,
+                       limits: CommentLimits = Depends(comment_limits),
+                       user: Identity = Depends(get_identity),
                        db: SessionLocal = Depends(get_db)):
-    user = db.query(User).filter(User.username == request.state.user.get("sub")).first()
-    posts_logger.info(
-        f"Followed users' messages read attempt by user: user={user.username}")
-    followed_users = db.query(Followers).filter(Followers.follower_id == user.id).all()
-    posts = db.query(Post). \
-        filter(Post.user_id.in_([follow.followed_id for follow in followed_users])). \
-        filter(Post.hidden == bool(0)). \
-        filter(Post.type == 1). \
-        offset((page - 1) * settings.POSTS_PER_PAGE). \
-        limit(settings.POSTS_PER_PAGE).all()
+    posts_read_logger.info(
+        "Followed users' messages read attempt by user: user=%s", user.username)
+    posts = timeline_page(user, db, page=page)[0] if page >= 1 else []
     if not posts:
         posts_logger.warning(
-            f"Page does not exist occurred: user={user.username}, endpoint=/posts/followed/{page}")
+            "Page does not exist occurred: user=%s, endpoint=/posts/followed/%s", user.username, page)
         raise HTTPException(status_code=404, detail="No such page")
-    posts_json = [{'id': post.id,
-                   'title': post.title,
-                   'content': post.content,
-                   'user': post.user.username,
-                   'date': str(post.created_at),
-                   'likes': db.query(func.count(Like.post_id)).filter(Like.post_id == post.id).scalar(),
-                   'comments': get_comments(post.id, db)}
-                  for post in posts]
-    posts_logger.info(
-        f"Followed users' messages read successfully by user: user={user.username}, posts={[post.id for post in posts]}")
-    return JSONResponse(content={"data": posts_json})
+    posts_json = posts_to_json(posts, db, limits)
+    posts_read_logger.info(
+        "Followed users' messages read successfully by user: user=%s, posts=%s", user.username, [post.id for post in posts])
+    return ORJSONResponse(content={"data": posts_json})
+
+
+@secure_router.get('/posts/followed', response_model=PostCursorPageOut)
+def followed_posts_cursor_get(request: Request,
+                              after: str | None = None,
+                              limits: CommentLimits = Depends(comment_limits),
+                              user: Identity = Depends(get_identity),
+                              db: SessionLocal = Depends(get_db)):
+    posts_read_logger.info(
+        "Followed users' messages read attempt by user: user=%s", user.username)
+    posts, next_cursor = timeline_page(user, db, after=after)
+    posts_json = posts_to_json(posts, db, limits)
+    posts_read_logger.info(
+        "Followed users' messages read successfully by user: user=%s, posts=%s", user.username, [post.id for post in posts])
+    return ORJSONResponse(content={"data": posts_json, "next_cursor": next_cursor})
 
 
 @secure_router.put('/posts/{post_id:int}/like')
 def post_like_get(request: Request,
                   post_id: int,
+                  identity: Identity = Depends(get_identity),
                   db: SessionLocal = Depends(get_db)):
-    user = db.query(User).filter(User.username == request.state.user.get("sub")).first()
+    user = db.get(User, identity.id)
     posts_logger.info(
-        f"Post like attempt by user: {user.username}, post={post_id}")
+        "Post like attempt by user: %s, post=%s", user.username, post_id)
     post = db.query(Post).filter(Post.id == post_id).first()
     if not post or post.hidden == bool(1):
         posts_logger.warning(
-            f"Post does not exist occurred: user={user.username}, endpoint=/posts/{post_id}/like")
+            "Post does not exist occurred: user=%s, endpoint=/posts/%s/like", user.username, post_id)
         raise HTTPException(status_code=404, detail="This post does not exist")
-    if not user.like(post, db):
-        posts_logger.warning(
-            f"Post already liked by user: user={user.username}")
-        raise HTTPException(status_code=403, detail="This post is already liked")
     if post.user_id == user.id:
         posts_logger.warning(
-                             f"Trying to like yourself by user: {user.username}, post={post_id}")
+                             "Trying to like yourself by user: %s, post=%s", user.username, post_id)
         raise HTTPException(status_code=403, detail="You can't like yourself")
+    if not (like_buffer.like(user.id, post.id, db) if settings.LIKE_BUFFER else user.like(post, db)):
+        posts_logger.warning(
+            "Post already liked by user: user=%s", user.username)
+        raise HTTPException(status_code=403, detail="This post is already liked")
     db.commit()
+    response_cache.invalidate(*post_tags(post_id))
     posts_logger.info(
-        f"Post like successfully by user: user={user.username}, post={post_id}")
+        "Post like successfully by user: user=%s, post=%s", user.username, post_id)
     db.close()
-    return JSONResponse(content={"message": "Successful"})
+    return ORJSONResponse(content={"message": "Successful"})
+
+
+@secure_router.put('/posts/bulk/like', response_model=BulkResultsOut)
+def posts_bulk_like(request: Request,
+                    body: BulkIds,
+                    identity: Identity = Depends(get_identity),
+                    db: SessionLocal = Depends(get_db)):
+    user = db.get(User, identity.id)
+    posts_logger.info(
+        "Bulk post like attempt by user: %s, posts=%s", user.username, len(body.ids))
+    authors = dict(db.query(Post.id, Post.user_id).
+                   filter(Post.id.in_(set(body.ids))).
+                   filter(Post.hidden == bool(0)).all())
+    to_like = sorted(post_id for post_id, author_id in authors.items() if author_id != user.id)
+    if settings.LIKE_BUFFER:
+        liked = {post_id for post_id in to_like if like_buffer.like(user.id, post_id, db)}
+    else:
+        liked = user.like_many(to_like, db)
+    db.commit()
+    response_cache.invalidate(*post_tags(*liked))
+
+    results = []
+    for post_id in body.ids:
+        if post_id not in authors:
+            result = "not_found"
+        elif authors[post_id] == user.id:
+            result = "own_post"
+        elif post_id in liked:
+            result = "liked"
+            liked.discard(post_id)
+        else:
+            result = "already_liked"
+        results.append({"id": post_id, "result": result})
+    posts_logger.info(
+        "Bulk post like successfully by user: user=%s, posts=%s", user.username, len(body.ids))
+    return ORJSONResponse(content={"results": results})
 
 
 @secure_router.delete('/posts/{post_id:int}/remove-like')
 def post_remove_like_get(request: Request,
                          post_id: int,
+                         identity: Identity = Depends(get_identity),
                          db: SessionLocal = Depends(get_db)):
-    user = db.query(User).filter(User.username == request.state.user.get("sub")).first()
+    user = db.get(User, identity.id)
     posts_logger.info(
-        f"Post like remove attempt by user: {user.username}, post={post_id}")
+        "Post like remove attempt by user: %s, post=%s", user.username, post_id)
     post = db.query(Post).filter(Post.id == post_id).first()
     if not post or post.hidden == bool(1):
         posts_logger.warning(
-            f"Post does not exist occurred: user={user.username}, endpoint=/posts/{post_id}/remove-like")
+            "Post does not exist occurred: user=%s, endpoint=/posts/%s/remove-like", user.username, post_id)
         raise HTTPException(status_code=404, detail="This post does not exist")
-    if not user.remove_like(post, db):
+    if not (like_buffer.remove_like(user.id, post.id, db) if settings.LIKE_BUFFER else user.remove_like(post, db)):
         posts_logger.warning(
-            f"Post isn't liked by user: {user.username}, post={post_id}")
+            "Post isn't liked by user: %s, post=%s", user.username, post_id)
         raise HTTPException(status_code=403, detail="This post isn't liked")
     db.commit()
+    response_cache.invalidate(*post_tags(post_id))
     posts_logger.info(
-        f"Post like remove successfully by user: user={user.username}, post={post_id}")
+        "Post like remove successfully by user: user=%s, post=%s", user.username, post_id)
     db.close()
-    return JSONResponse(content={"message": "Successful"})
+    return ORJSONResponse(content={"message": "Successful"})
 
 
 @secure_router.post('/posts/{post_id}/comment')
 def post_comment_post(request: Request,
                       comment: PostCreate,
                       post_id: int,
+                      user: Identity = Depends(get_identity),
                       db: SessionLocal = Depends(get_db)):
-    user = db.query(User).filter(User.username == request.state.user.get("sub")).first()
     posts_logger.info(
-        f"Post comment attempt by user: {user.username}, post={post_id}")
+        "Post comment attempt by user: %s, post=%s", user.username, post_id)
     post_to_comment = db.query(Post).filter(Post.id == post_id).first()
     if not post_to_comment:
         posts_logger.warning(
-            f"Post does not exist occurred: user={user.username}, endpoint=/posts/{post_id}/comment")
+            "Post does not exist occurred: user=%s, endpoint=/posts/%s/comment", user.username, post_id)
         raise HTTPException(status_code=404, detail="No such post")
     if post_to_comment.type in (2, 3):
         posts_logger.warning(
-            f"Post can't be commented due to it's type by user: {user.username}, post={post_id}")
+            "Post can't be commented due to it's type by user: %s, post=%s", user.username, post_id)
         raise HTTPException(status_code=403, detail="You can't comment comment or answer")
     db_post = Post(
         title=comment.title,
@@ -220,29 +394,35 @@ def post_comment_post(request: Request,
         refer_to=post_id
     )
     db.add(db_post)
+    db.flush()
+    index_post(db_post, db)
+    db.query(Post). \
+        filter(Post.id == post_id). \
+        update(counter_updates(replies=1))
     db.commit()
+    response_cache.invalidate(*post_tags(post_id))
     db.refresh(db_post)
     posts_logger.info(
-        f"Post comment successfully by user: {user.username}, post={post_id}, comment={db_post.id}")
-    return JSONResponse(status_code=200, content={"message": "Comment published"})
+        "Post comment successfully by user: %s, post=%s, comment=%s", user.username, post_id, db_post.id)
+    return ORJSONResponse(status_code=200, content={"message": "Comment published"})
 
 
 @secure_router.post('/posts/{post_id}/answer')
 def post_answer_post(request: Request,
                      answer: PostCreate,
                      post_id: int,
+                     user: Identity = Depends(get_identity),
                      db: SessionLocal = Depends(get_db)):
-    user = db.query(User).filter(User.username == request.state.user.get("sub")).first()
     posts_logger.info(
-        f"Comment answer attempt by user: {user.username}, post={post_id}")
+        "Comment answer attempt by user: %s, post=%s", user.username, post_id)
     post_to_answer = db.query(Post).filter(Post.id == post_id).first()
     if not post_to_answer:
         posts_logger.warning(
-            f"Post does not exist occurred: user={user.username}, endpoint=/posts/{post_id}/answer")
+            "Post does not exist occurred: user=%s, endpoint=/posts/%s/answer", user.username, post_id)
         raise HTTPException(status_code=404, detail="No such post")
     if post_to_answer.type == 1:
         posts_logger.warning(
-            f"Post can't be answered due to it's type by user: {user.username}, post={post_id}")
+            "Post can't be answered due to it's type by user: %s, post=%s", user.username, post_id)
         raise HTTPException(status_code=403, detail="You can't answer to the post")
     db_post = Post(
         title=answer.title,
@@ -252,8 +432,14 @@ def post_answer_post(request: Request,
         refer_to=post_id
     )
     db.add(db_post)
+    db.flush()
+    index_post(db_post, db)
+    db.query(Post). \
+        filter(Post.id == post_id). \
+        update(counter_updates(replies=1))
     db.commit()
+    response_cache.invalidate(*post_tags(post_id))
     db.refresh(db_post)
     posts_logger.info(
-        f"Post answer successfully by user: {user.username}, post={post_id}, answer={db_post.id}")
-    return JSONResponse(status_code=200, content={"message": "Answer published"})
+        "Post answer successfully by user: %s, post=%s, answer=%s", user.username, post_id, db_post.id)
+    return ORJSONResponse(status_code=200, content={"message": "Answer published"})
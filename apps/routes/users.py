@@ -1,64 +1,73 @@
-from apps.dependencies import get_db, SessionLocal, get_comments, hash_password
-from apps.schemas import UserProfileEdit, UserPasswordChange
+from apps.dependencies import get_db, SessionLocal, hash_password, posts_to_json, Identity, get_identity, \
+    paginate_posts_by_page, paginate_posts_by_cursor, get_profile, profile_cache, CommentLimits, comment_limits
+from apps.schemas import UserProfileEdit, UserPasswordChange, UserProfile, PostOut, PostCursorPageOut, BulkIds, \
+    BulkResultsOut
+from apps.response_cache import response_cache
+from apps.timeline import backfill_followers, backfill_timeline, backfill_timelines, prune_timeline
 
-from database.models import User, Post, Followers, Like
+from database.models import User, Post
 from . import secure_router, guest_router
 from config import settings
 
 from fastapi import Depends, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse
 
-from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import joinedload
 import jwt
 
-@guest_router.get('/users/{user_id:int}')
-def user_get(user_id,
+@guest_router.get('/users/{user_id:int}', response_model=UserProfile)
+def user_get(user_id: int,
              db: SessionLocal = Depends(get_db)):
-    user = db.query(User).filter(User.id == user_id).first()
-    if not user:
+    user_info = get_profile(user_id, db)
+    if not user_info:
         raise HTTPException(status_code=400, detail="No such user")
-    user_info = {
-        "username": user.username,
-        "last_seen": str(user.last_seen),
-        "followers": db.query(func.count(Followers.follower_id)).filter(Followers.followed_id == user.id).scalar(),
-        "following": db.query(func.count(Followers.followed_id)).filter(Followers.follower_id == user.id).scalar(),
-        "posts": db.query(func.count(Post.id)).filter(Post.user_id == user.id).filter(Post.type == 1).scalar()
-    }
-    return JSONResponse(content=user_info)
-
-@guest_router.get('/users/{user_id:int}/posts/{page:int}')
+    return ORJSONResponse(content=user_info)
+
+def user_posts_query(user, db):
+    return db.query(Post). \
+        options(joinedload(Post.user)). \
+        filter(Post.user_id == user.id). \
+        filter(Post.hidden == bool(0)). \
+        filter(Post.type == 1)
+
+@guest_router.get('/users/{user_id:int}/posts/{page:int}', response_model=list[PostOut])
 def user_posts_get(page: int,
                    user_id,
+                   limits: CommentLimits = Depends(comment_limits),
                    db: SessionLocal = Depends(get_db)):
     user = db.query(User).filter(User.id == user_id).first()
     if not user:
-        return HTTPException(status_code=400, detail="No such user")
-    posts = db.query(Post). \
-        filter(Post.user_id == user.id). \
-        filter(Post.hidden == bool(0)). \
-        filter(Post.type == 1). \
-        offset((page - 1) * settings.POSTS_PER_PAGE). \
-        limit(settings.POSTS_PER_PAGE).all()
+        raise HTTPException(status_code=400, detail="No such user")
+    posts = paginate_posts_by_page(user_posts_query(user, db), page)
     if not posts:
-        return HTTPException(status_code=400, detail="No such page")
-    posts_json = [{'id': post.id,
-                   'title': post.title,
-                   'content': post.content,
-                   'user': post.user.username,
-                   'date': str(post.created_at),
-                   'likes': db.query(func.count(Like.post_id)).filter(Like.post_id == post.id).scalar(),
-                   'comments': get_comments(post.id, db)}
-                  for post in posts]
+        raise HTTPException(status_code=400, detail="No such page")
+    posts_json = posts_to_json(posts, db, limits)
     db.close()
-    return JSONResponse(content=posts_json)
+    return ORJSONResponse(content=posts_json)
+
+@guest_router.get('/users/{user_id:int}/posts', response_model=PostCursorPageOut)
+def user_posts_cursor_get(user_id: int,
+                          after: str | None = None,
+                          limits: CommentLimits = Depends(comment_limits),
+                          db: SessionLocal = Depends(get_db)):
+    user = db.query(User).filter(User.id == user_id).first()
+    if not user:
+        raise HTTPException(status_code=400, detail="No such user")
+    posts, next_cursor = paginate_posts_by_cursor(user_posts_query(user, db), after)
+    posts_json = posts_to_json(posts, db, limits)
+    db.close()
+    return ORJSONResponse(content={"data": posts_json, "next_cursor": next_cursor})
 
 @secure_router.put('/users/{user_to_follow_id:int}/follow')
 def follow_get(request: Request,
                user_to_follow_id: int,
+               identity: Identity = Depends(get_identity),
                db: SessionLocal = Depends(get_db)
                ):
 
-    user = db.query(User).filter(User.username == request.state.user.get("sub")).first()
+    user = db.get(User, identity.id)
     user_to_follow = db.query(User).filter(User.id == user_to_follow_id).first()
     if not user_to_follow:
         raise HTTPException(status_code=400, detail="No such user")
@@ -66,15 +75,46 @@ def follow_get(request: Request,
         raise HTTPException(status_code=400, detail="You can't follow yourself")
     if not user.follow(user_to_follow, db):
         raise HTTPException(status_code=400, detail="You already following this user")
+    backfill_timeline(user.id, user_to_follow.id, db)
     db.commit()
-    return JSONResponse(status_code=200, content={"message": "Followed successfully"})
+    profile_cache.pop(user.id)
+    profile_cache.pop(user_to_follow.id)
+    return ORJSONResponse(status_code=200, content={"message": "Followed successfully"})
+
+@secure_router.put('/users/bulk/follow', response_model=BulkResultsOut)
+def bulk_follow_put(request: Request,
+                    body: BulkIds,
+                    identity: Identity = Depends(get_identity),
+                    db: SessionLocal = Depends(get_db)):
+    user = db.get(User, identity.id)
+    existing = {user_id for user_id, in db.query(User.id).filter(User.id.in_(set(body.ids)))}
+    followed = user.follow_many(sorted(existing - {user.id}), db)
+    backfill_timelines(user.id, sorted(followed), db)
+    db.commit()
+    for user_id in (user.id, *followed):
+        profile_cache.pop(user_id)
+
+    results = []
+    for user_id in body.ids:
+        if user_id not in existing:
+            result = "not_found"
+        elif user_id == user.id:
+            result = "self"
+        elif user_id in followed:
+            result = "followed"
+            followed.discard(user_id)
+        else:
+            result = "already_following"
+        results.append({"id": user_id, "result": result})
+    return ORJSONResponse(content={"results": results})
 
 @secure_router.delete('/users/{user_to_unfollow_id:int}/unfollow')
 def unfollow_get(request: Request,
                  user_to_unfollow_id: int,
+                 identity: Identity = Depends(get_identity),
                  db: SessionLocal = Depends(get_db)):
 
-    user = db.query(User).filter(User.username == request.state.user.get("sub")).first()
+    user = db.get(User, identity.id)
     user_to_unfollow = db.query(User).filter(User.id == user_to_unfollow_id).first()
     if not user_to_unfollow:
         raise HTTPException(status_code=400, detail="No such user")
@@ -82,29 +122,41 @@ def unfollow_get(request: Request,
         raise HTTPException(status_code=400, detail="You can't unfollow yourself")
     if not user.unfollow(user_to_unfollow, db):
         raise HTTPException(status_code=400, detail="You aren't following this user")
+    prune_timeline(user.id, user_to_unfollow.id, db)
+    backfill_followers(user_to_unfollow.id, db)
     db.commit()
-    return JSONResponse(status_code=200, content={"message": "Unfollowed successfully"})
+    profile_cache.pop(user.id)
+    profile_cache.pop(user_to_unfollow.id)
+    return ORJSONResponse(status_code=200, content={"message": "Unfollowed successfully"})
 
 @secure_router.patch('/users/edit-profile')
 def edit_profile_post(request: Request,
                       user_body: UserProfileEdit,
+                      identity: Identity = Depends(get_identity),
                       db: SessionLocal = Depends(get_db)):
-    user = db.query(User).filter(User.username == request.state.user.get("sub")).first()
-    if db.query(User).filter(User.username == user_body.username).first():
-        raise HTTPException(status_code=400, detail="Username is already used")
-    if db.query(User).filter(User.email == user_body.email).first():
+    user = db.get(User, identity.id)
+    if taken := db.query(User.username). \
+            filter(or_(User.username == user_body.username, User.email == user_body.email)). \
+            first():
+        if taken.username == user_body.username:
+            raise HTTPException(status_code=400, detail="Username is already used")
         raise HTTPException(status_code=400, detail="Email is already used")
     user.username = user_body.username
     user.email = user_body.email
-    db.commit()
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=400, detail="Username or email is already used")
+    # usernames are embedded in every cached post and comment
+    response_cache.clear()
     db.refresh(user)
 
-    access_token = request.cookies.get("access_token")
-    access_token = jwt.decode(access_token, settings.SECRET_KEY, settings.ALGORITHM)
+    access_token = dict(request.state.user)
     access_token["sub"] = user.username
     access_token = jwt.encode(access_token, settings.SECRET_KEY, settings.ALGORITHM)
 
-    server_response = JSONResponse(status_code=200, content={"message": "Successful"})
+    server_response = ORJSONResponse(status_code=200, content={"message": "Successful"})
     server_response.set_cookie(key="access_token", value=access_token, httponly=True, secure=True)
 
     return server_response
@@ -112,10 +164,11 @@ def edit_profile_post(request: Request,
 @secure_router.patch('/users/change-password')
 def change_password_post(request: Request,
                          user_body: UserPasswordChange,
+                         identity: Identity = Depends(get_identity),
                          db: SessionLocal = Depends(get_db)):
-    user = db.query(User).filter(User.username == request.state.user.get("sub")).first()
+    user = db.get(User, identity.id)
     user.hashed_password = hash_password(user_body.password)
     db.commit()
     db.refresh(user)
 
-    return JSONResponse(status_code=200, content={"message": "Successful"})
+    return ORJSONResponse(status_code=200, content={"message": "Successful"})
@@ -1,4 +1,6 @@
+from datetime import datetime
 from pydantic import BaseModel, EmailStr, Field, ConfigDict
+from config import settings
 
 class UserBase(BaseModel):
     username: str = Field(min_length=5, max_length=20)
@@ -26,7 +28,76 @@ class PostBase(BaseModel):
 class PostCreate(PostBase):
     pass
 
+class PostBulkCreate(BaseModel):
+    posts: list[PostCreate] = Field(min_length=1, max_length=settings.BULK_MAX_ITEMS)
+
+class BulkIds(BaseModel):
+    ids: list[int] = Field(min_length=1, max_length=settings.BULK_MAX_ITEMS)
+
+class BulkResult(BaseModel):
+    id: int
+    result: str
+
+class BulkResultsOut(BaseModel):
+    results: list[BulkResult]
+
 class Post(PostBase):
     model_config = ConfigDict(from_attributes=True)
     id: int
     user_id: int
+
+class CommentOut(PostBase):
+    id: int
+    user: str
+    date: datetime
+    likes: int
+    answers: list["CommentOut"] = []
+    # only on nodes whose replies were cut short, see /posts/{post_id}/replies
+    reply_count: int | None = None
+    cursor: str | None = None
+
+class PostOut(PostBase):
+    id: int
+    user: str
+    date: datetime
+    likes: int
+    comments: list[CommentOut] = []
+    reply_count: int | None = None
+    cursor: str | None = None
+
+class PostDetail(PostBase):
+    id: int
+    user: str
+    date: datetime
+    likes: int
+    comment_for: int | None = None
+    answer_for: int | None = None
+    comments: list[CommentOut] | None = None
+    answers: list[CommentOut] | None = None
+    reply_count: int | None = None
+    cursor: str | None = None
+
+class PostDetailOut(BaseModel):
+    data: PostDetail
+
+class PostPageOut(BaseModel):
+    data: list[PostOut]
+
+class PostCursorPageOut(PostPageOut):
+    next_cursor: str | None = None
+
+class RepliesPageOut(BaseModel):
+    data: list[CommentOut]
+    next_cursor: str | None = None
+
+class SearchPageOut(BaseModel):
+    data: list[PostDetail]
+    next_cursor: str | None = None
+
+class UserProfile(BaseModel):
+    username: str
+    last_seen: datetime | None
+    followers: int
+    following: int
+    posts: int
+    likes: int
@@ -0,0 +1,93 @@
+import re
+
+from fastapi import HTTPException
+from sqlalchemy import delete, func, insert, literal_column, text, tuple_
+from sqlalchemy.orm import joinedload
+
+from apps.dependencies import decode_cursor, encode_cursor, like_buffer
+from config import settings
+from database.models import Post, SEARCH_DOCUMENT, posts_search
+
+# Search runs on ix_posts_search on Postgres and on the posts_search FTS5 table on SQLite.
+# The FTS5 table is kept by index_post / unindex_post; on Postgres they do nothing.
+
+_search_document = literal_column(f"to_tsvector({SEARCH_DOCUMENT})")
+
+
+def _uses_fts(db):
+    return db.get_bind().dialect.name == "sqlite"
+
+
+def index_post(post, db):
+    """Make a new or unhidden post searchable."""
+    if _uses_fts(db):
+        db.execute(insert(posts_search).values(rowid=post.id, title=post.title, content=post.content))
+
+
+def index_posts(posts, db):
+    """``index_post`` for a batch of new posts, given as dicts with id, title and content."""
+    if _uses_fts(db) and posts:
+        db.execute(insert(posts_search),
+                   [{"rowid": post["id"], "title": post["title"], "content": post["content"]} for post in posts])
+
+
+def unindex_post(post, db):
+    """Drop a hidden post from the search results."""
+    if _uses_fts(db):
+        db.execute(delete(posts_search).where(posts_search.c.rowid == post.id))
+
+
+def _search_query(db, q: str):
+    """Visible posts matching ``q`` together with their rank, higher ranks matching better."""
+    if _uses_fts(db):
+        terms = re.findall(r"\w+", q)
+        if not terms:
+            raise HTTPException(status_code=400, detail="Empty search query")
+        rank = -func.bm25(literal_column("posts_search"))
+        return db.query(Post, rank.label("rank")). \
+            join(posts_search, posts_search.c.rowid == Post.id). \
+            filter(literal_column("posts_search").op("MATCH")(" ".join(f'"{term}"' for term in terms))). \
+            filter(Post.hidden == bool(0)), rank
+    query = func.websearch_to_tsquery(text("'english'::regconfig"), q)
+    rank = func.ts_rank_cd(_search_document, query)
+    return db.query(Post, rank.label("rank")). \
+        filter(_search_document.bool_op("@@")(query)). \
+        filter(Post.hidden == bool(0)), rank
+
+
+def search_posts(db, q: str, after: str | None):
+    """Return one page of posts matching ``q``, best first, and the cursor of the next page."""
+    search_query, rank = _search_query(db, q)
+    if after:
+        try:
+            after_rank, after_id = decode_cursor(after)
+            after_rank, after_id = float(after_rank), int(after_id)
+        except (TypeError, ValueError):
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        search_query = search_query.filter(tuple_(rank, Post.id) < (after_rank, after_id))
+    results = search_query. \
+        options(joinedload(Post.user)). \
+        order_by(rank.desc(), Post.id.desc()). \
+        limit(settings.POSTS_PER_PAGE + 1).all()
+    next_cursor = None
+    if len(results) > settings.POSTS_PER_PAGE:
+        results = results[:settings.POSTS_PER_PAGE]
+        next_cursor = encode_cursor(results[-1][1], results[-1][0].id)
+    return [post for post, _ in results], next_cursor
+
+
+def search_results_to_json(posts):
+    results = []
+    for post in posts:
+        result = {'id': post.id,
+                  'title': post.title,
+                  'content': post.content,
+                  'user': post.user.username,
+                  'date': post.created_at,
+                  'likes': like_buffer.like_count(post.id, post.like_count)}
+        if post.type == 2:
+            result['comment_for'] = post.refer_to
+        elif post.type == 3:
+            result['answer_for'] = post.refer_to
+        results.append(result)
+    return results
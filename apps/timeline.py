@@ -0,0 +1,153 @@
+from sqlalchemy import func, insert, literal, select, tuple_
+from sqlalchemy.orm import joinedload
+
+from apps.dependencies import decode_post_cursor, encode_cursor
+from config import settings
+from database.models import Post, User, Followers, Timeline, insert_or_ignore
+
+# Home timelines are fanned out on write: a new top-level post is copied into the timeline
+# of every follower of its author. Authors with more than TIMELINE_FANOUT_LIMIT followers
+# are skipped and their posts are pulled from the posts table when a timeline is read.
+
+
+def fan_out_post(post, db):
+    """Push a new top-level post into the timelines of its author's followers."""
+    followers_count = db.query(User.followers_count).filter(User.id == post.user_id).scalar()
+    if not followers_count or followers_count > settings.TIMELINE_FANOUT_LIMIT:
+        return
+    followers = db.query(Followers.follower_id,
+                         literal(post.id),
+                         literal(post.user_id),
+                         literal(post.created_at)). \
+        filter(Followers.followed_id == post.user_id)
+    db.execute(insert(Timeline).from_select(
+        ["user_id", "post_id", "author_id", "created_at"], followers))
+
+
+def fan_out_posts(author_id, post_ids, db):
+    """``fan_out_post`` for a batch of new top-level posts by the same author, in one statement."""
+    followers_count = db.query(User.followers_count).filter(User.id == author_id).scalar()
+    if not post_ids or not followers_count or followers_count > settings.TIMELINE_FANOUT_LIMIT:
+        return
+    entries = db.query(Followers.follower_id, Post.id, Post.user_id, Post.created_at). \
+        join(Post, Post.user_id == Followers.followed_id). \
+        filter(Followers.followed_id == author_id). \
+        filter(Post.id.in_(post_ids))
+    db.execute(insert(Timeline).from_select(
+        ["user_id", "post_id", "author_id", "created_at"], entries))
+
+
+def backfill_timeline(follower_id, followed_id, db):
+    """Copy the latest posts of a newly followed user into the follower's timeline."""
+    followers_count = db.query(User.followers_count).filter(User.id == followed_id).scalar()
+    if followers_count > settings.TIMELINE_FANOUT_LIMIT:
+        return
+    posts = db.query(literal(follower_id), Post.id, Post.user_id, Post.created_at). \
+        filter(Post.user_id == followed_id). \
+        filter(Post.hidden == bool(0)). \
+        filter(Post.type == 1). \
+        order_by(Post.created_at.desc(), Post.id.desc()). \
+        limit(settings.TIMELINE_BACKFILL)
+    db.execute(insert(Timeline).from_select(
+        ["user_id", "post_id", "author_id", "created_at"], posts))
+
+
+def backfill_timelines(follower_id, followed_ids, db):
+    """``backfill_timeline`` for several newly followed users, in one statement."""
+    if not followed_ids:
+        return
+    latest_posts = select(Post.id, Post.user_id, Post.created_at,
+                          func.row_number().over(partition_by=Post.user_id,
+                                                 order_by=(Post.created_at.desc(), Post.id.desc())).label("position")). \
+        filter(Post.user_id.in_(followed_ids)). \
+        filter(Post.hidden == bool(0)). \
+        filter(Post.type == 1). \
+        subquery()
+    posts = select(literal(follower_id), latest_posts.c.id, latest_posts.c.user_id, latest_posts.c.created_at). \
+        join(User, User.id == latest_posts.c.user_id). \
+        filter(User.followers_count <= settings.TIMELINE_FANOUT_LIMIT). \
+        filter(latest_posts.c.position <= settings.TIMELINE_BACKFILL)
+    db.execute(insert(Timeline).from_select(
+        ["user_id", "post_id", "author_id", "created_at"], posts))
+
+
+def backfill_followers(author_id, db):
+    """Copy an author's latest posts into their followers' timelines once the author is fanned out again.
+
+    Posts made while the author had more than TIMELINE_FANOUT_LIMIT followers were pulled
+    at read time instead of fanned out; when an unfollow brings the author back to the
+    limit they are no longer pulled, so the latest TIMELINE_BACKFILL of them are fanned
+    out here. Call it after the unfollow; it does nothing unless the count is now exactly
+    at the limit.
+    """
+    followers_count = db.query(User.followers_count).filter(User.id == author_id).scalar()
+    if followers_count != settings.TIMELINE_FANOUT_LIMIT:
+        return
+    latest_posts = select(Post.id, Post.user_id, Post.created_at). \
+        filter(Post.user_id == author_id). \
+        filter(Post.hidden == bool(0)). \
+        filter(Post.type == 1). \
+        order_by(Post.created_at.desc(), Post.id.desc()). \
+        limit(settings.TIMELINE_BACKFILL). \
+        subquery()
+    entries = select(Followers.follower_id, latest_posts.c.id, latest_posts.c.user_id, latest_posts.c.created_at). \
+        join(latest_posts, latest_posts.c.user_id == Followers.followed_id)
+    # posts from before the author crossed the limit are already there
+    db.execute(insert_or_ignore(db, Timeline).from_select(
+        ["user_id", "post_id", "author_id", "created_at"], entries))
+
+
+def prune_timeline(follower_id, followed_id, db):
+    """Drop an unfollowed user's posts from the follower's timeline."""
+    db.query(Timeline). \
+        filter(Timeline.user_id == follower_id). \
+        filter(Timeline.author_id == followed_id). \
+        delete(synchronize_session=False)
+
+
+def _newest_first(posts_query, created_at, post_id, after, limit):
+    if after:
+        posts_query = posts_query.filter(tuple_(created_at, post_id) < after)
+    return posts_query. \
+        order_by(created_at.desc(), post_id.desc()). \
+        limit(limit).all()
+
+
+def timeline_page(user, db, page: int | None = None, after: str | None = None):
+    """Return a page of the user's home timeline and the cursor of the next one.
+
+    Fanned-out entries and the posts of followed high-follower authors are each read with an
+    index range scan and merged by (created_at, id). Pass either a page number or a cursor.
+    """
+    per_page = settings.POSTS_PER_PAGE
+    limit = page * per_page if page is not None else per_page + 1
+    after = decode_post_cursor(after) if after else None
+
+    fanned = db.query(Post). \
+        options(joinedload(Post.user)). \
+        join(Timeline, Timeline.post_id == Post.id). \
+        filter(Timeline.user_id == user.id). \
+        filter(Post.hidden == bool(0))
+    followed_popular = db.query(Followers.followed_id). \
+        join(User, User.id == Followers.followed_id). \
+        filter(Followers.follower_id == user.id). \
+        filter(User.followers_count > settings.TIMELINE_FANOUT_LIMIT)
+    pulled = db.query(Post). \
+        options(joinedload(Post.user)). \
+        filter(Post.user_id.in_(followed_popular.scalar_subquery())). \
+        filter(Post.hidden == bool(0)). \
+        filter(Post.type == 1)
+
+    fanned = _newest_first(fanned, Timeline.created_at, Timeline.post_id, after, limit)
+    pulled = _newest_first(pulled, Post.created_at, Post.id, after, limit)
+    # an author who crossed the fan-out limit can have a post in both
+    posts = sorted({post.id: post for post in fanned + pulled}.values(),
+                   key=lambda post: (post.created_at, post.id), reverse=True)
+
+    if page is not None:
+        return posts[(page - 1) * per_page:page * per_page], None
+    next_cursor = None
+    if len(posts) > per_page:
+        posts = posts[:per_page]
+        next_cursor = encode_cursor(posts[-1].created_at, posts[-1].id)
+    return posts, next_cursor
@@ -0,0 +1,309 @@
+"""Benchmark every route of the app in-process against a seeded database.
+
+    python -m benchmarks.run --save-baseline benchmarks/baseline.json
+    python -m benchmarks.run --baseline benchmarks/baseline.json
+
+Requests go through the ASGI app with httpx, no server or network involved. For each
+endpoint the runner reports p50/p99 latency, throughput and SQL statements per request;
+``--baseline`` compares the run with a saved one and flags endpoints that got slower or
+started issuing more statements. Startup is reported too: a cold import and build of the
+app in a fresh interpreter, then building and starting the one being measured.
+
+The runner seeds a fresh SQLite database in a temporary directory and ignores
+DATABASE_URL. To benchmark another database, pass ``--database-url`` together with
+``--reset``: every table in that database is dropped and seeded again.
+"""
+from argparse import ArgumentParser
+from dataclasses import dataclass
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+# the app reads its settings on import; the database is always one the runner created, an
+# exported DATABASE_URL would otherwise have all its tables dropped
+_workdir = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(_workdir, 'benchmark.db')}"
+os.environ.setdefault("LOG_DIR", os.path.join(_workdir, "logs"))
+# register, login and change-password would otherwise measure little but bcrypt
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
+# every request comes from one client, the limiter would turn most auth requests into 429s
+os.environ.setdefault("AUTH_RATE_LIMIT", "0")
+
+import httpx
+from fastapi.routing import APIRoute
+from sqlalchemy import select
+
+from apps import console_handler, create_app
+from apps.dependencies import SessionLocal, create_access_token, get_engine
+from apps.query_stats import server_timing_queries
+from benchmarks.seed import Dataset, PASSWORD, seed
+from config import settings
+from database.models import Base, Post, User, Like, Followers
+
+READER = "user00002"
+
+
+@dataclass
+class Case:
+    name: str
+    method: str
+    path: str
+    auth: str | None = None
+    body: object = None
+    # name of the id pool that fills {id} in path and body, one id per request
+    pool: str | None = None
+
+
+def cases():
+    """Every endpoint, reads first: writes change what the reads would see."""
+    return [
+        Case("home", "GET", "/"),
+        Case("metrics", "GET", "/metrics"),
+        Case("post", "GET", "/posts/{id}", pool="posts"),
+        Case("replies", "GET", "/posts/{id}/replies", pool="posts"),
+        Case("posts page", "GET", "/posts/all/{id}", pool="pages"),
+        Case("posts cursor", "GET", "/posts/all"),
+        Case("hot posts", "GET", "/posts/hot"),
+        Case("top posts", "GET", "/posts/top?window=month"),
+        Case("search", "GET", "/posts/search?q=fastapi+cache"),
+        Case("followed page", "GET", "/posts/followed/{id}", auth=READER, pool="pages"),
+        Case("followed cursor", "GET", "/posts/followed", auth=READER),
+        Case("user", "GET", "/users/{id}", pool="users"),
+        Case("user posts page", "GET", "/users/{id}/posts/1", pool="authors"),
+        Case("user posts cursor", "GET", "/users/{id}/posts", pool="authors"),
+        Case("export", "GET", "/admin/export/posts?include_comments=true&since=2000-01-01", auth="user00001"),
+        Case("register", "POST", "/auth/register",
+             body={"username": "bench{id}", "email": "bench{id}@example.org", "password": PASSWORD}, pool="serial"),
+        Case("login", "POST", "/auth/login",
+             body={"username": READER, "email": "user2@example.org", "password": PASSWORD}),
+        Case("logout", "GET", "/auth/logout", auth=READER),
+        Case("create post", "POST", "/posts/create", auth=READER, body={"title": "title", "content": "content"}),
+        Case("bulk create posts", "POST", "/posts/bulk/create", auth=READER,
+             body={"posts": [{"title": "bulk title", "content": "bulk content"}] * 20}),
+        Case("comment", "POST", "/posts/{id}/comment", auth=READER, body={"title": "c", "content": "c"}, pool="posts"),
+        Case("answer", "POST", "/posts/{id}/answer", auth=READER, body={"title": "a", "content": "a"}, pool="comments"),
+        Case("like", "PUT", "/posts/{id}/like", auth=READER, pool="unliked"),
+        Case("remove like", "DELETE", "/posts/{id}/remove-like", auth=READER, pool="liked"),
+        Case("bulk like", "PUT", "/posts/bulk/like", auth=READER, body={"ids": ["{id}"]}, pool="unliked"),
+        Case("follow", "PUT", "/users/{id}/follow", auth=READER, pool="unfollowed"),
+        Case("unfollow", "DELETE", "/users/{id}/unfollow", auth=READER, pool="followed"),
+        Case("bulk follow", "PUT", "/users/bulk/follow", auth=READER, body={"ids": ["{id}"]}, pool="unfollowed"),
+        Case("remove post", "PUT", "/posts/remove/{id}", auth=READER, pool="own_posts"),
+        Case("hide post", "PUT", "/admin/hide-post/{id}", auth="user00001", pool="posts"),
+        Case("edit profile", "PATCH", "/users/edit-profile", auth="user00003",
+             body={"username": "renamed{id}", "email": "renamed{id}@example.org"}, pool="serial"),
+        Case("change password", "PATCH", "/users/change-password", auth=READER, body={"password": PASSWORD}),
+    ]
+
+
+def id_pools(db, requests):
+    """Ids each case can use, so that every request does the work its endpoint exists for."""
+    reader_id = db.query(User.id).filter(User.username == READER).scalar()
+    visible = db.query(Post.id).filter(Post.hidden == bool(0))
+    liked = select(Like.post_id).filter(Like.user_id == reader_id)
+    followed = select(Followers.followed_id).filter(Followers.follower_id == reader_id)
+    return {
+        # user 1 is the admin, whose posts can't be hidden
+        "posts": [post_id for post_id, in visible.filter(Post.type == 1).filter(Post.user_id.not_in((1, reader_id))).
+                  order_by(Post.id).limit(requests)],
+        "comments": [post_id for post_id, in visible.filter(Post.type == 2).order_by(Post.id).limit(requests)],
+        "unliked": [post_id for post_id, in visible.filter(Post.user_id != reader_id).filter(Post.id.not_in(liked)).
+                    order_by(Post.id.desc()).limit(requests)],
+        "liked": [post_id for post_id, in db.query(Like.post_id).filter(Like.user_id == reader_id).
+                  order_by(Like.post_id.desc()).limit(requests)],
+        "own_posts": [post_id for post_id, in visible.filter(Post.user_id == reader_id).
+                      order_by(Post.id.desc()).limit(requests)],
+        "users": [user_id for user_id, in db.query(User.id).order_by(User.id).limit(requests)],
+        "authors": [user_id for user_id, in db.query(User.id).order_by(User.followers_count.desc()).limit(requests)],
+        "unfollowed": [user_id for user_id, in db.query(User.id).filter(User.id != reader_id).
+                       filter(User.id.not_in(followed)).order_by(User.id).limit(requests)],
+        "followed": [user_id for user_id, in db.query(Followers.followed_id).
+                     filter(Followers.follower_id == reader_id).order_by(Followers.followed_id).limit(requests)],
+        "pages": [1 + i % 5 for i in range(requests)],
+        "serial": list(range(requests)),
+    }
+
+
+def _fill(value, pool_id):
+    if isinstance(value, str):
+        filled = value.replace("{id}", str(pool_id))
+        return int(filled) if value == "{id}" else filled
+    if isinstance(value, list):
+        return [_fill(item, pool_id) for item in value]
+    if isinstance(value, dict):
+        return {key: _fill(item, pool_id) for key, item in value.items()}
+    return value
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run_case(client, case, ids, tokens, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+    queries = []
+    errors = 0
+
+    async def one(pool_id):
+        nonlocal errors
+        headers = {"Cookie": f"access_token={tokens[case.auth]}"} if case.auth else {}
+        async with semaphore:
+            started = time.perf_counter()
+            response = await client.request(case.method, _fill(case.path, pool_id),
+                                            json=_fill(case.body, pool_id), headers=headers)
+            latencies.append(time.perf_counter() - started)
+        queries.append(server_timing_queries(response.headers["Server-Timing"]))
+        client.cookies.clear()
+        if response.status_code >= 400:
+            errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(pool_id) for pool_id in ids))
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(ids),
+        "errors": errors,
+        "p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "throughput_rps": round(len(ids) / elapsed, 1),
+        "sql_per_request": round(sum(queries) / len(ids), 2),
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Endpoints slower than the baseline by more than ``tolerance``, or issuing more SQL."""
+    regressions = []
+    for name, result in results.items():
+        if (before := baseline.get("endpoints", {}).get(name)) is None:
+            continue
+        if result["sql_per_request"] > before["sql_per_request"]:
+            regressions.append(f"{name}: {before['sql_per_request']} -> {result['sql_per_request']} SQL per request")
+        # sub-millisecond differences are noise whatever the ratio
+        if result["p50_ms"] > before["p50_ms"] * (1 + tolerance) and result["p50_ms"] - before["p50_ms"] > 1:
+            regressions.append(f"{name}: p50 {before['p50_ms']} -> {result['p50_ms']} ms")
+    return regressions
+
+
+def cold_start_ms() -> float:
+    """Time to import the app and build it in a fresh interpreter, what every new worker pays."""
+    script = "import time; started = time.perf_counter(); from apps import create_app; create_app(); " \
+             "print(time.perf_counter() - started)"
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return round(float(output.stdout.strip().splitlines()[-1]) * 1000, 1)
+
+
+async def benchmark(args):
+    dataset = Dataset(**{field: getattr(args, field) for field in Dataset().as_dict()})
+    engine = get_engine()
+    if args.reset:
+        Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        print("seeded", seed(db, dataset), file=sys.stderr)
+        tokens = {username: create_access_token({"sub": username, "uid": user_id, "role": role_id})
+                  for user_id, username, role_id in db.query(User.id, User.username, User.role_id).
+                  filter(User.id <= 3)}
+    finally:
+        db.close()
+
+    selected = [case for case in cases() if not args.only or case.name in args.only]
+    covered = {(case.method, case.path.split("?")[0]) for case in cases()}
+    results = {}
+    startup = {"cold_start_ms": cold_start_ms()}
+    started = time.perf_counter()
+    app = create_app()
+    startup["create_app_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    transport = httpx.ASGITransport(app=app)
+    # the transport does not run the lifespan, the runner enters it itself
+    started = time.perf_counter()
+    async with app.router.lifespan_context(app), \
+            httpx.AsyncClient(transport=transport, base_url="http://benchmark") as client:
+        startup["lifespan_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        print(f"{'startup':20} {startup}", file=sys.stderr)
+        for case in selected:
+            db = SessionLocal()
+            try:
+                pools = id_pools(db, args.requests + args.warmup)
+            finally:
+                db.close()
+            ids = pools[case.pool] if case.pool else [0] * (args.requests + args.warmup)
+            if len(ids) <= args.warmup:
+                print(f"skipping {case.name}: not enough data for it", file=sys.stderr)
+                continue
+            await run_case(client, case, ids[:args.warmup], tokens, args.concurrency)
+            results[case.name] = await run_case(client, case, ids[args.warmup:], tokens, args.concurrency)
+            print(f"{case.name:20} {results[case.name]}", file=sys.stderr)
+
+    for route in app.routes:
+        if not isinstance(route, APIRoute):
+            continue
+        for method in route.methods:
+            path = route.path.replace(":int", "")
+            if method in ("GET", "POST", "PUT", "PATCH", "DELETE") and not any(
+                    method == covered_method and _same_route(path, covered_path)
+                    for covered_method, covered_path in covered):
+                print(f"not benchmarked: {method} {route.path}", file=sys.stderr)
+    return {"dataset": dataset.as_dict(), "requests": args.requests, "concurrency": args.concurrency,
+            "startup": startup, "endpoints": results}
+
+
+def _same_route(route_path, case_path):
+    route_parts, case_parts = route_path.strip("/").split("/"), case_path.strip("/").split("/")
+    return len(route_parts) == len(case_parts) and all(
+        route_part == case_part or route_part.startswith("{")
+        for route_part, case_part in zip(route_parts, case_parts))
+
+
+def main():
+    parser = ArgumentParser(description="Benchmark every route in-process")
+    for field, default in Dataset(users=500, posts=2000, likes=5000).as_dict().items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    parser.add_argument("--requests", type=int, default=100, help="measured requests per endpoint")
+    parser.add_argument("--warmup", type=int, default=5, help="unmeasured requests per endpoint")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--only", nargs="*", help="benchmark only these endpoints")
+    parser.add_argument("--output", help="write the results to this JSON file")
+    parser.add_argument("--save-baseline", help="write the results as the baseline to compare later runs with")
+    parser.add_argument("--baseline", help="compare the results with this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed p50 slowdown against the baseline")
+    parser.add_argument("--database-url", help="benchmark this database instead of a temporary SQLite one")
+    parser.add_argument("--reset", action="store_true",
+                        help="drop every table in --database-url first, required with it")
+    args = parser.parse_args()
+    if args.database_url:
+        if not args.reset:
+            parser.error("--database-url drops and reseeds every table in that database, pass --reset to confirm")
+        # no engine exists yet, the first use creates it from this
+        settings.DATABASE_URL = args.database_url
+    elif args.reset:
+        parser.error("--reset only applies to --database-url, the temporary database starts empty")
+
+    console_handler.setLevel(logging.WARNING)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+
+    results = asyncio.run(benchmark(args))
+    output = json.dumps(results, indent=2)
+    print(output)
+    for path in (args.output, args.save_baseline):
+        if path:
+            with open(path, "w") as file:
+                file.write(output)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results["endpoints"], json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+"""Generate a synthetic dataset for the benchmarks.
+
+    python -m benchmarks.seed --users 2000 --posts 20000
+
+Everything is derived from ``--seed``, so the same arguments always produce the same data.
+Follows, post authorship and likes are skewed with a Zipf-like distribution: a few users
+and posts get most of the attention, like on the real site.
+"""
+from argparse import ArgumentParser
+from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta
+import random
+
+from sqlalchemy import insert, text
+
+from apps.hashing import hash_password
+from database.maintenance import recount, rebuild_timelines, rebuild_search_index
+from database.models import Base, Role, PostType, User, Followers, Post, Like
+
+PASSWORD = "password"
+WORDS = ("fastapi", "python", "database", "index", "query", "cache", "latency", "async", "timeline",
+         "comment", "answer", "follow", "like", "search", "server", "client", "token", "session")
+
+
+@dataclass
+class Dataset:
+    users: int = 1000
+    posts: int = 5000
+    follows_per_user: int = 20
+    comments_per_post: float = 2.0
+    answer_depth: int = 6
+    likes: int = 20000
+    skew: float = 1.1
+    seed: int = 1
+
+    def as_dict(self):
+        return asdict(self)
+
+
+def _zipf_weights(n, skew):
+    return [1 / (rank ** skew) for rank in range(1, n + 1)]
+
+
+def _text(rnd, words):
+    return " ".join(rnd.choice(WORDS) for _ in range(words))
+
+
+def _insert(db, model, rows, batch=5000):
+    for start in range(0, len(rows), batch):
+        db.execute(insert(model), rows[start:start + batch])
+
+
+def seed(db, dataset: Dataset):
+    """Fill an empty database with ``dataset``. User 1 is an admin, every password is PASSWORD."""
+    rnd = random.Random(dataset.seed)
+    now = datetime.utcnow()
+    hashed_password = hash_password(PASSWORD)
+
+    _insert(db, Role, [{"id": 1, "name": "user"}, {"id": 2, "name": "admin"}])
+    _insert(db, PostType, [{"id": 1, "name": "post"}, {"id": 2, "name": "comment"}, {"id": 3, "name": "answer"}])
+    _insert(db, User, [{"id": user_id,
+                        "username": f"user{user_id:05d}",
+                        "email": f"user{user_id}@example.org",
+                        "role_id": 2 if user_id == 1 else 1,
+                        "hashed_password": hashed_password,
+                        "created_at": now - timedelta(days=60),
+                        "last_seen": now}
+                       for user_id in range(1, dataset.users + 1)])
+
+    user_ids = list(range(1, dataset.users + 1))
+    popularity = _zipf_weights(dataset.users, dataset.skew)
+    follows = set()
+    for follower_id in user_ids:
+        for followed_id in rnd.choices(user_ids, popularity, k=dataset.follows_per_user):
+            if followed_id != follower_id:
+                follows.add((follower_id, followed_id))
+    _insert(db, Followers, [{"follower_id": follower_id, "followed_id": followed_id}
+                            for follower_id, followed_id in sorted(follows)])
+
+    posts = []
+    for post_id in range(1, dataset.posts + 1):
+        posts.append({"id": post_id,
+                      "title": _text(rnd, 4),
+                      "content": _text(rnd, 40),
+                      "user_id": rnd.choices(user_ids, popularity)[0],
+                      "created_at": now - timedelta(seconds=rnd.randrange(30 * 24 * 3600)),
+                      "hidden": rnd.random() < 0.02,
+                      "type": 1,
+                      "refer_to": None})
+    next_id = dataset.posts + 1
+    post_weights = _zipf_weights(dataset.posts, dataset.skew)
+    for _ in range(int(dataset.posts * dataset.comments_per_post)):
+        parent = posts[rnd.choices(range(dataset.posts), post_weights)[0]]
+        # every comment starts a chain of answers up to answer_depth long
+        for depth in range(rnd.randint(0, dataset.answer_depth) + 1):
+            posts.append({"id": next_id,
+                          "title": _text(rnd, 3),
+                          "content": _text(rnd, 15),
+                          "user_id": rnd.choice(user_ids),
+                          "created_at": parent["created_at"] + timedelta(minutes=depth + 1),
+                          "hidden": False,
+                          "type": 2 if depth == 0 else 3,
+                          "refer_to": parent["id"]})
+            parent = posts[-1]
+            next_id += 1
+    _insert(db, Post, posts)
+
+    authors = {post["id"]: post["user_id"] for post in posts}
+    liked_weights = _zipf_weights(len(posts), dataset.skew)
+    post_ids = [post["id"] for post in posts]
+    likes = set()
+    for post_id in rnd.choices(post_ids, liked_weights, k=dataset.likes):
+        user_id = rnd.choice(user_ids)
+        if user_id != authors[post_id]:
+            likes.add((user_id, post_id))
+    _insert(db, Like, [{"user_id": user_id, "post_id": post_id} for user_id, post_id in sorted(likes)])
+    if db.get_bind().dialect.name == "postgresql":
+        # ids were given explicitly, move the sequences past them
+        for table in ("roles", "ptypes", "users", "followers", "posts", "likes"):
+            db.execute(text(f"SELECT setval(pg_get_serial_sequence('{table}', 'id'), "
+                            f"(SELECT coalesce(max(id), 1) FROM {table}))"))
+    db.commit()
+
+    recount(db)
+    rebuild_timelines(db)
+    rebuild_search_index(db)
+    return {"users": dataset.users, "follows": len(follows), "posts": len(posts), "likes": len(likes)}
+
+
+if __name__ == '__main__':
+    from apps import start_logging, stop_logging
+    from apps.dependencies import SessionLocal, engine
+
+    parser = ArgumentParser(description="Generate a synthetic dataset into DATABASE_URL")
+    for field, default in Dataset().as_dict().items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=default)
+    parser.add_argument("--reset", action="store_true", help="drop and recreate every table first")
+    args = parser.parse_args()
+
+    start_logging()
+    if args.reset:
+        Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    db = SessionLocal()
+    try:
+        print(seed(db, Dataset(**{field: getattr(args, field) for field in Dataset().as_dict()})))
+    finally:
+        db.close()
+        stop_logging()
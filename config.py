@@ -5,6 +5,65 @@ class settings:
         pass
 
     SECRET_KEY = str(os.getenv("SECRET_KEY"))
+    DEBUG = os.getenv("DEBUG", "1") == "1"
+    LOG_DIR = os.getenv("LOG_DIR", "logs")
     POSTS_PER_PAGE = 15
+    # comment trees in responses, the defaults and the most a client may ask for with max_depth and max_children
+    COMMENT_MAX_DEPTH = int(os.getenv("COMMENT_MAX_DEPTH", 3))
+    COMMENT_MAX_CHILDREN = int(os.getenv("COMMENT_MAX_CHILDREN", 10))
+    COMMENT_DEPTH_LIMIT = int(os.getenv("COMMENT_DEPTH_LIMIT", 10))
+    COMMENT_CHILDREN_LIMIT = int(os.getenv("COMMENT_CHILDREN_LIMIT", 100))
+    # authors followed by more users than this are merged into timelines at read time instead of fanned out
+    TIMELINE_FANOUT_LIMIT = int(os.getenv("TIMELINE_FANOUT_LIMIT", 5000))
+    TIMELINE_BACKFILL = int(os.getenv("TIMELINE_BACKFILL", 100))
+    # feed rankings: a reply counts this many likes, and hot posts need ten times the likes to outrank
+    # posts this many seconds newer
+    SCORE_REPLY_WEIGHT = float(os.getenv("SCORE_REPLY_WEIGHT", 2))
+    HOT_SCORE_DECAY = float(os.getenv("HOT_SCORE_DECAY", 45000))
     ALGORITHM = "HS256"
     EXPIRED_TIME = 15
+    TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", 10000))
+    IDENTITY_CACHE_SIZE = int(os.getenv("IDENTITY_CACHE_SIZE", 10000))
+    IDENTITY_CACHE_TTL = float(os.getenv("IDENTITY_CACHE_TTL", 60))
+    PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 10000))
+    PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", 30))
+    RESPONSE_CACHE_BYTES = int(os.getenv("RESPONSE_CACHE_BYTES", 32 * 1024 * 1024))
+    BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+    BCRYPT_WORKERS = int(os.getenv("BCRYPT_WORKERS", min(4, os.cpu_count() or 1)))
+    BCRYPT_QUEUE_SIZE = int(os.getenv("BCRYPT_QUEUE_SIZE", 64))
+    BCRYPT_TIMEOUT = float(os.getenv("BCRYPT_TIMEOUT", 5))
+    # token buckets in front of login and register, attempts per minute and how many may come at once
+    AUTH_RATE_LIMIT = os.getenv("AUTH_RATE_LIMIT", "1") == "1"
+    AUTH_IP_RATE = float(os.getenv("AUTH_IP_RATE", 30))
+    AUTH_IP_BURST = int(os.getenv("AUTH_IP_BURST", 10))
+    AUTH_USERNAME_RATE = float(os.getenv("AUTH_USERNAME_RATE", 6))
+    AUTH_USERNAME_BURST = int(os.getenv("AUTH_USERNAME_BURST", 5))
+    RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))
+    # SQLite file holding the buckets so every worker shares them, empty keeps them per process
+    RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "")
+    BULK_MAX_ITEMS = int(os.getenv("BULK_MAX_ITEMS", 500))
+    # write likes and unlikes behind through apps.like_buffer instead of in the request
+    LIKE_BUFFER = os.getenv("LIKE_BUFFER", "0") == "1"
+    LIKE_FLUSH_INTERVAL = int(os.getenv("LIKE_FLUSH_INTERVAL", 200))  # milliseconds
+    LIKE_FLUSH_SIZE = int(os.getenv("LIKE_FLUSH_SIZE", 500))
+    EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", 1000))
+    LOG_BATCH_SIZE = int(os.getenv("LOG_BATCH_SIZE", 256))
+    # fraction of successful post read events that are logged
+    LOG_READ_SAMPLE_RATE = float(os.getenv("LOG_READ_SAMPLE_RATE", 0.1))
+    # a statement run this many times in one request is logged as a likely N+1 query
+    SQL_REPEAT_THRESHOLD = int(os.getenv("SQL_REPEAT_THRESHOLD", 5))
+    # log the statement count and database time of every request
+    SQL_LOG_REQUESTS = os.getenv("SQL_LOG_REQUESTS", "0") == "1"
+    DATABASE_URL = os.getenv("DATABASE_URL", "postgresql://postgres:@localhost/fastapi")
+    DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", 5))
+    DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", 10))
+    DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 30))
+    DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "1") == "1"
+    DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", 1800))
+    # checkouts waiting longer than this many seconds for a pooled connection are logged as warnings
+    DB_SLOW_CHECKOUT = float(os.getenv("DB_SLOW_CHECKOUT", 0.1))
+    # page cache per SQLite connection, negative values are KiB
+    SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", -64000))
+    # serve every route as ``async def`` on top of an AsyncSession instead of the threadpool
+    ASYNC_DB = os.getenv("ASYNC_DB", "0") == "1"
+    ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", "postgresql+asyncpg://postgres:@localhost/fastapi")
@@ -0,0 +1,117 @@
+from argparse import ArgumentParser
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.orm import aliased
+
+from config import settings
+from database.models import Post, Like, User, Followers, Timeline, posts_search, create_posts_search, score_values
+
+
+def recount_post_counters(db):
+    """Recompute Post.like_count and Post.comment_count from the likes and posts tables."""
+    reply = aliased(Post)
+
+    likes = select(func.count(Like.id)). \
+        filter(Like.post_id == Post.id). \
+        correlate(Post). \
+        scalar_subquery()
+    replies = select(func.count(reply.id)). \
+        filter(reply.refer_to == Post.id). \
+        filter(reply.hidden == bool(0)). \
+        correlate(Post). \
+        scalar_subquery()
+
+    updated = db.query(Post). \
+        update({Post.like_count: likes, Post.comment_count: replies}, synchronize_session=False)
+    db.commit()
+    return updated
+
+
+def rescore_posts(db):
+    """Recompute Post.hot_score and Post.top_score from the counters.
+
+    Likes and replies keep the scores in step as they come, this repairs drift and applies
+    new SCORE_REPLY_WEIGHT or HOT_SCORE_DECAY settings.
+    """
+    updated = db.query(Post). \
+        update(score_values(), synchronize_session=False)
+    db.commit()
+    return updated
+
+
+def recount_user_counters(db):
+    """Recompute User.followers_count from the followers table."""
+    followers = select(func.count(Followers.id)). \
+        filter(Followers.followed_id == User.id). \
+        correlate(User). \
+        scalar_subquery()
+
+    updated = db.query(User). \
+        update({User.followers_count: followers}, synchronize_session=False)
+    db.commit()
+    return updated
+
+
+def recount(db):
+    return recount_post_counters(db) + rescore_posts(db) + recount_user_counters(db)
+
+
+def rebuild_timelines(db):
+    """Refill every fanned-out timeline with the latest TIMELINE_BACKFILL posts of each followed author."""
+    latest_posts = select(Post.id, Post.user_id, Post.created_at,
+                          func.row_number().over(partition_by=Post.user_id,
+                                                 order_by=(Post.created_at.desc(), Post.id.desc())).label("position")). \
+        filter(Post.hidden == bool(0)). \
+        filter(Post.type == 1). \
+        subquery()
+    entries = select(Followers.follower_id, latest_posts.c.id, latest_posts.c.user_id, latest_posts.c.created_at). \
+        join(latest_posts, latest_posts.c.user_id == Followers.followed_id). \
+        join(User, User.id == Followers.followed_id). \
+        filter(User.followers_count <= settings.TIMELINE_FANOUT_LIMIT). \
+        filter(latest_posts.c.position <= settings.TIMELINE_BACKFILL)
+
+    db.query(Timeline).delete(synchronize_session=False)
+    inserted = db.execute(insert(Timeline).from_select(
+        ["user_id", "post_id", "author_id", "created_at"], entries)).rowcount
+    db.commit()
+    return inserted
+
+
+def rebuild_search_index(db):
+    """Refill the SQLite posts_search table from the visible posts, creating it if needed.
+
+    Postgres keeps ix_posts_search up to date by itself, there is nothing to rebuild there.
+    """
+    if db.get_bind().dialect.name != "sqlite":
+        return 0
+    db.execute(create_posts_search)
+    db.execute(delete(posts_search))
+    inserted = db.execute(insert(posts_search).from_select(
+        ["rowid", "title", "content"],
+        select(Post.id, Post.title, Post.content).filter(Post.hidden == bool(0)))).rowcount
+    db.commit()
+    return inserted
+
+
+COMMANDS = {
+    "recount": recount,
+    "scores": rescore_posts,
+    "timelines": rebuild_timelines,
+    "search": rebuild_search_index,
+}
+
+if __name__ == '__main__':
+    from apps import start_logging, stop_logging
+    from apps.dependencies import SessionLocal
+
+    parser = ArgumentParser(description="Repair denormalized data")
+    parser.add_argument("command", choices=COMMANDS)
+    args = parser.parse_args()
+
+    start_logging()
+    db = SessionLocal()
+    try:
+        print(f"{args.command}: {COMMANDS[args.command](db)} rows updated")
+    finally:
+        db.close()
+        stop_logging()
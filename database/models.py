@@ -1,10 +1,21 @@
-from sqlalchemy import String, Integer, ForeignKey, Column, DateTime, Boolean
-from sqlalchemy.orm import relationship, declarative_base
+from sqlalchemy import String, Integer, Float, ForeignKey, Column, DateTime, Boolean, Index, UniqueConstraint, \
+    DDL, case, delete, event, extract, func, text
+from sqlalchemy.sql import column, table
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import relationship, declarative_base, object_session
 from datetime import datetime
+import math
+
+from config import settings
 
 
 Base = declarative_base()
 
+def insert_or_ignore(db, model):
+    """INSERT ... ON CONFLICT DO NOTHING for the dialect the session is bound to."""
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    return dialect.insert(model).on_conflict_do_nothing()
+
 class Role(Base):
     __tablename__ = 'roles'
 
@@ -19,6 +30,10 @@ class PostType(Base):
 
 class Followers(Base):
     __tablename__ = 'followers'
+    __table_args__ = (
+        UniqueConstraint('follower_id', 'followed_id', name='uq_followers_pair'),
+        Index('ix_followers_followed', 'followed_id', 'follower_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     follower_id = Column(Integer, ForeignKey('users.id'))
@@ -32,12 +47,13 @@ class User(Base):
     __tablename__ = 'users'
 
     id = Column(Integer, primary_key=True, index=True)
-    username = Column(String(20), index=True)
-    email = Column(String(340), index=True)
+    username = Column(String(20), index=True, unique=True)
+    email = Column(String(340), index=True, unique=True)
     role_id = Column(Integer, ForeignKey('roles.id'), default=1)
     hashed_password = Column(String, index=True)
     created_at = Column(DateTime)
     last_seen = Column(DateTime, default=datetime.utcnow())
+    followers_count = Column(Integer, default=0, server_default="0", nullable=False)
 
     posts = relationship("Post", back_populates="user")
     likes = relationship("Like", back_populates="user")
@@ -65,44 +81,97 @@ class User(Base):
         self.created_at = datetime.utcnow()
 
     def follow(self, user_to_follow, db):
-        if not db.query(Followers). \
-                filter(Followers.follower_id == self.id). \
-                filter(Followers.followed_id == user_to_follow.id). \
-                first():
-            db.add(Followers(follower_id=self.id, followed_id=user_to_follow.id))
+        if db.execute(insert_or_ignore(db, Followers).
+                      values(follower_id=self.id, followed_id=user_to_follow.id).
+                      returning(Followers.id)).first():
+            db.query(User). \
+                filter(User.id == user_to_follow.id). \
+                update({User.followers_count: User.followers_count + 1})
             return True
         return False
 
     def unfollow(self, user_to_unfollow, db):
-        if follow_to_cancel := db.query(Followers). \
-                filter(Followers.follower_id == self.id). \
-                filter(Followers.followed_id == user_to_unfollow.id). \
-                first():
-            db.delete(follow_to_cancel)
+        if db.execute(delete(Followers).
+                      filter(Followers.follower_id == self.id).
+                      filter(Followers.followed_id == user_to_unfollow.id).
+                      returning(Followers.id)).first():
+            db.query(User). \
+                filter(User.id == user_to_unfollow.id). \
+                update({User.followers_count: User.followers_count - 1})
             return True
         return False
 
+    def follow_many(self, user_ids, db):
+        """Follow every user in ``user_ids`` at once, returning the ids that were not followed yet."""
+        if not user_ids:
+            return set()
+        followed = set(db.scalars(insert_or_ignore(db, Followers).
+                                  values([{"follower_id": self.id, "followed_id": user_id} for user_id in user_ids]).
+                                  returning(Followers.followed_id)))
+        if followed:
+            db.query(User). \
+                filter(User.id.in_(followed)). \
+                update({User.followers_count: User.followers_count + 1}, synchronize_session=False)
+        return followed
+
     def like(self, post_to_like, db):
-        if not db.query(Like). \
-                filter(Like.user_id == self.id). \
-                filter(Like.post_id == post_to_like.id). \
-                first():
-            db.add(Like(user=self, post=post_to_like))
-            db.commit()
+        if db.execute(insert_or_ignore(db, Like).
+                      values(user_id=self.id, post_id=post_to_like.id).
+                      returning(Like.id)).first():
+            db.query(Post). \
+                filter(Post.id == post_to_like.id). \
+                update(counter_updates(likes=1))
             return True
         return False
 
+    def like_many(self, post_ids, db):
+        """Like every post in ``post_ids`` at once, returning the ids that were not liked yet."""
+        if not post_ids:
+            return set()
+        liked = set(db.scalars(insert_or_ignore(db, Like).
+                               values([{"user_id": self.id, "post_id": post_id} for post_id in post_ids]).
+                               returning(Like.post_id)))
+        if liked:
+            db.query(Post). \
+                filter(Post.id.in_(liked)). \
+                update(counter_updates(likes=1), synchronize_session=False)
+        return liked
+
     def remove_like(self, post_to_remove_like, db):
-        if like_to_remove := db.query(Like). \
-                filter(Like.user_id == self.id). \
-                filter(Like.post_id == post_to_remove_like.id). \
-                first():
-            db.delete(like_to_remove)
+        if db.execute(delete(Like).
+                      filter(Like.user_id == self.id).
+                      filter(Like.post_id == post_to_remove_like.id).
+                      returning(Like.id)).first():
+            db.query(Post). \
+                filter(Post.id == post_to_remove_like.id). \
+                update(counter_updates(likes=-1))
             return True
         return False
 
+SEARCH_DOCUMENT = "'english'::regconfig, coalesce(title, '') || ' ' || coalesce(content, '')"
+
 class Post(Base):
     __tablename__ = 'posts'
+    __table_args__ = (
+        # keyset pagination seeks on (created_at, id) after the equality filters of each feed,
+        # the public feed only ever reads visible top-level posts
+        Index('ix_posts_feed', 'created_at', 'id',
+              postgresql_where=text("hidden = false AND type = 1"),
+              sqlite_where=text("hidden = 0 AND type = 1")),
+        Index('ix_posts_user_feed', 'user_id', 'hidden', 'type', 'created_at', 'id'),
+        Index('ix_posts_refer_to', 'refer_to', 'hidden', 'id'),
+        # the hot and top feeds read visible top-level posts in score order
+        Index('ix_posts_hot', 'hot_score', 'id',
+              postgresql_where=text("hidden = false AND type = 1"),
+              sqlite_where=text("hidden = 0 AND type = 1")),
+        Index('ix_posts_top', 'top_score', 'id',
+              postgresql_where=text("hidden = false AND type = 1"),
+              sqlite_where=text("hidden = 0 AND type = 1")),
+        # full-text search on Postgres, kept up to date by Postgres itself; queries have to
+        # repeat the indexed expression, see apps.search
+        Index('ix_posts_search', text(f"to_tsvector({SEARCH_DOCUMENT})"),
+              postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
 
@@ -111,6 +180,13 @@ class Post(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     hidden = Column(Boolean, default=0)
 
+    like_count = Column(Integer, default=0, server_default="0", nullable=False)
+    comment_count = Column(Integer, default=0, server_default="0", nullable=False)
+    # rankings kept in step with the counters by counter_updates, see hot_score and top_score
+    hot_score = Column(Float, default=lambda context: hot_score(0, 0, context.get_current_parameters()["created_at"]),
+                       server_default="0", nullable=False)
+    top_score = Column(Float, default=0, server_default="0", nullable=False)
+
     user_id = Column(ForeignKey('users.id'))
     user = relationship("User", back_populates="posts")
     likes = relationship("Like", back_populates="post")
@@ -124,13 +200,76 @@ class Post(Base):
                             remote_side=[id])
 
     def hide(self):
+        if not self.hidden:
+            self._count_as_reply(-1)
         self.hidden = True
 
     def unhide(self):
+        if self.hidden:
+            self._count_as_reply(1)
         self.hidden = False
 
+    def _count_as_reply(self, delta):
+        # comment_count only counts visible replies, so hiding a comment or an answer
+        # has to be reflected on the post it refers to
+        if self.refer_to is not None and (db := object_session(self)):
+            db.query(Post). \
+                filter(Post.id == self.refer_to). \
+                update(counter_updates(replies=delta))
+
+# Rankings for the hot and top feeds. top_score weighs comments against likes; hot_score is
+# the log of it plus the post's age in HOT_SCORE_DECAY units, so a post needs ten times the
+# engagement to rank level with one that is HOT_SCORE_DECAY seconds newer. Anchoring the
+# age to SCORE_EPOCH instead of to now means scores only change with the counters.
+SCORE_EPOCH = datetime(2024, 1, 1)
+
+def top_score(likes, replies):
+    return likes + settings.SCORE_REPLY_WEIGHT * replies
+
+def hot_score(likes: int, replies: int, created_at: datetime) -> float:
+    return math.log10(max(top_score(likes, replies), 1)) + \
+        (created_at - SCORE_EPOCH).total_seconds() / settings.HOT_SCORE_DECAY
+
+def _log_engagement(likes, replies):
+    engagement = top_score(likes, replies)
+    return func.log(case((engagement > 1, engagement), else_=1))
+
+def counter_updates(likes=0, replies=0) -> dict:
+    """UPDATE values changing Post.like_count and Post.comment_count by the given amounts, scores included.
+
+    The amounts may be SQL expressions, like bind parameters of an executemany.
+    """
+    return {
+        Post.like_count: Post.like_count + likes,
+        Post.comment_count: Post.comment_count + replies,
+        Post.top_score: Post.top_score + top_score(likes, replies),
+        Post.hot_score: Post.hot_score - _log_engagement(Post.like_count, Post.comment_count) +
+        _log_engagement(Post.like_count + likes, Post.comment_count + replies),
+    }
+
+def score_values() -> dict:
+    """UPDATE values recomputing both scores from the counters, the SQL version of hot_score and top_score."""
+    return {
+        Post.top_score: top_score(Post.like_count, Post.comment_count),
+        Post.hot_score: _log_engagement(Post.like_count, Post.comment_count) +
+        (extract('epoch', Post.created_at) - (SCORE_EPOCH - datetime(1970, 1, 1)).total_seconds()) /
+        settings.HOT_SCORE_DECAY,
+    }
+
+# Full-text search on SQLite: visible posts are copied into an FTS5 table that apps.search
+# maintains as posts are created and hidden. Postgres searches ix_posts_search instead.
+posts_search = table('posts_search', column('rowid'), column('title'), column('content'))
+create_posts_search = DDL("CREATE VIRTUAL TABLE IF NOT EXISTS posts_search "
+                          "USING fts5(title, content, tokenize='porter unicode61')")
+event.listen(Post.__table__, "after_create", create_posts_search.execute_if(dialect='sqlite'))
+event.listen(Post.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS posts_search").execute_if(dialect='sqlite'))
+
 class Like(Base):
     __tablename__ = 'likes'
+    __table_args__ = (
+        UniqueConstraint('post_id', 'user_id', name='uq_likes_post_user'),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     post_id = Column(Integer, ForeignKey('posts.id'))
@@ -141,3 +280,16 @@ class Like(Base):
     def __init__(self, user, post):
         self.user = user
         self.post = post
+
+class Timeline(Base):
+    """Fanned-out home timeline: one row per (reader, post by someone the reader follows)."""
+    __tablename__ = 'timeline'
+    __table_args__ = (
+        Index('ix_timeline_feed', 'user_id', 'created_at', 'post_id'),
+        Index('ix_timeline_author', 'user_id', 'author_id'),
+    )
+
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    post_id = Column(Integer, ForeignKey('posts.id'), primary_key=True)
+    author_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    created_at = Column(DateTime, nullable=False)
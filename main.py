@@ -1,14 +1,9 @@
-from uvicorn import run
-# noinspection PyUnresolvedReferences
-from apps.routes import auth, posts, users, admin,\
-    secure_router, guest_router, admin_router
-from apps import app
+from apps import create_app
 
-app.include_router(secure_router)
-app.include_router(guest_router)
-app.include_router(admin_router)
+app = create_app()
 
 if __name__ == '__main__':
+    from uvicorn import run
     run(
         app
     )
@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# run the suite against a throwaway SQLite database unless told otherwise
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}")
+os.environ.setdefault("BCRYPT_ROUNDS", "4")
@@ -0,0 +1,9 @@
+from apps.query_stats import server_timing_queries
+
+
+def assert_max_queries(response, budget: int):
+    """Fail when the request behind ``response`` ran more than ``budget`` SQL statements."""
+    queries = server_timing_queries(response.headers["Server-Timing"])
+    assert queries <= budget, f"{response.request.method} {response.request.url.path} ran {queries} queries, " \
+                              f"the budget is {budget}"
+    return queries
@@ -0,0 +1,97 @@
+import asyncio
+import inspect
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
+from apps.dependencies import AsyncSessionLocal
+from apps.query_stats import QueryStatsMiddleware
+from apps.routes import secure_router, guest_router, admin_router, asyncify_router, verify_token
+# noinspection PyUnresolvedReferences
+from apps.routes import admin, auth, posts, users
+from database.models import Base
+from tests.helpers import assert_max_queries
+
+@pytest.fixture(scope="module")
+def client(tmp_path_factory):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path_factory.mktemp('db') / 'async.db'}",
+                                 poolclass=NullPool)
+
+    async def create_tables():
+        async with engine.begin() as connection:
+            await connection.run_sync(Base.metadata.create_all)
+
+    asyncio.run(create_tables())
+    AsyncSessionLocal.configure(bind=engine)
+    async_app = FastAPI()
+    async_app.middleware("http")(verify_token)
+    async_app.add_middleware(QueryStatsMiddleware)
+    for router in (secure_router, guest_router, admin_router):
+        async_app.include_router(asyncify_router(router))
+    with TestClient(async_app) as client:
+        yield client
+    AsyncSessionLocal.configure(bind=None)
+
+def test_async_routes(client):
+    for route in asyncify_router(secure_router).routes:
+        if route.path != '/auth/logout':
+            assert inspect.iscoroutinefunction(route.endpoint)
+
+def test_async_post_flow(client):
+    author = {"username": "async_author", "email": "author@example.org", "password": "password"}
+    reader = {"username": "async_reader", "email": "reader@example.org", "password": "password"}
+    assert client.post('/auth/register', json=author).status_code == 200
+    assert client.post('/auth/register', json=reader).status_code == 200
+    assert client.post('/auth/register', json=reader).status_code == 400
+
+    client.cookies = {"access_token": client.post('/auth/login', json=author).cookies.get("access_token")}
+    assert client.post('/posts/create', json={"title": "post", "content": "content"}).status_code == 200
+    assert client.post('/posts/1/comment', json={"title": "comment", "content": "content"}).status_code == 200
+
+    client.cookies = {"access_token": client.post('/auth/login', json=reader).cookies.get("access_token")}
+    assert client.put('/posts/2/like').status_code == 200
+    assert client.put('/users/1/follow').status_code == 200
+
+    response = client.get('/posts/followed')
+    assert response.status_code == 200
+    assert client.get('/posts/followed/0').status_code == 404
+    post = response.json()["data"][0]
+    assert post["user"] == "async_author"
+    assert post["comments"][0]["likes"] == 1
+    assert client.get('/posts/1').json()["data"]["comments"] == post["comments"]
+    assert client.get('/users/1').json()["followers"] == 1
+
+def test_async_response_cache(client):
+    response = client.get('/posts/1')
+    etag = response.headers["ETag"]
+    assert client.get('/posts/1', headers={"If-None-Match": etag}).status_code == 304
+    assert client.delete('/posts/2/remove-like').status_code == 200
+    response = client.get('/posts/1', headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["data"]["comments"][0]["likes"] == 0
+    assert response.headers["ETag"] != etag
+
+def test_async_bulk_writes(client):
+    # signed in as async_reader (id 2), already following async_author (id 1)
+    response = client.post('/posts/bulk/create', json={"posts": [{"title": f"bulk {i}", "content": "content"}
+                                                                  for i in range(3)]})
+    assert response.status_code == 200
+    created = [result["id"] for result in response.json()["results"]]
+    assert len(created) == 3 and created == sorted(created)
+    assert client.get(f'/posts/{created[0]}').json()["data"]["title"] == "bulk 0"
+
+    response = client.put('/users/bulk/follow', json={"ids": [1, 2, 999]})
+    assert [result["result"] for result in response.json()["results"]] == ["already_following", "self", "not_found"]
+    response = client.put('/posts/bulk/like', json={"ids": [1, 1, created[0], 999]})
+    assert [result["result"] for result in response.json()["results"]] == \
+           ["liked", "already_liked", "own_post", "not_found"]
+    assert client.get('/posts/1').json()["data"]["likes"] == 1
+    assert client.put('/posts/bulk/like', json={"ids": list(range(10_000))}).status_code == 422
+
+def test_async_query_budget(client):
+    # the comment trees of a whole page come from one recursive query, whatever their size
+    assert_max_queries(client.get('/posts/followed'), 3)
+    assert_max_queries(client.get('/posts/all?after=WyIyMDk5LTAxLTAxIiwgMV0'), 2)
+    assert_max_queries(client.get('/users/1'), 1)
+    assert_max_queries(client.put('/posts/1/like'), 5)
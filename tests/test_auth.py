@@ -1,15 +1,19 @@
+import bcrypt
 import jwt
 import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
 from config import settings
 from apps import app
-from apps.routes import secure_router, guest_router  # admin_router
-# noinspection PyUnresolvedReferences
-from apps.routes import admin, auth, posts, users
+from apps.dependencies import create_access_token, decode_token, token_cache, engine
+from apps.hashing import hash_password, check_password, needs_rehash
+from apps.query_stats import server_timing_queries
+from apps.rate_limit import MemoryStore, SQLiteStore, RateLimiter, login_limiter
+from database.models import Base
 from random import randint
+import time
 
-app.include_router(secure_router)
-app.include_router(guest_router)
+Base.metadata.create_all(engine)
 
 @pytest.fixture
 def client():
@@ -47,3 +51,93 @@ def test_login(client, user):
     client.cookies = {"access_token": token2}
     response3 = client.get('/')
     assert response3.status_code == 401
+
+def test_password_hashing():
+    hashed_password = hash_password("password")
+    assert check_password("password", hashed_password)
+    assert not check_password("wrong password", hashed_password)
+    assert not needs_rehash(hashed_password)
+    assert needs_rehash(bcrypt.hashpw(b"password", bcrypt.gensalt(settings.BCRYPT_ROUNDS + 1)).decode('utf-8'))
+
+def test_password_hashing_timeout(monkeypatch):
+    from apps import hashing
+    monkeypatch.setattr(settings, "BCRYPT_TIMEOUT", 0.2)
+    with pytest.raises(HTTPException) as error:
+        hashing._run(time.sleep, 1)
+    assert error.value.status_code == 503
+    # the job had started, it keeps its slot until it is done
+    assert hashing.queue_depth() == 1
+    hashing.shutdown_pool()
+    assert hashing.queue_depth() == 0
+
+def test_token_cache():
+    token = create_access_token({"sub": "cached_user"})
+    misses, hits = token_cache.misses, token_cache.hits
+    assert decode_token(token)["sub"] == "cached_user"
+    assert decode_token(token)["sub"] == "cached_user"
+    assert (token_cache.misses, token_cache.hits) == (misses + 1, hits + 1)
+    token_cache.set(token, decode_token(token), expires_at=time.time() - 1)
+    assert decode_token(token)["sub"] == "cached_user"
+    assert token_cache.misses == misses + 2
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_rate_limiter(tmp_path, shared):
+    store = SQLiteStore(str(tmp_path / "limits.db"), 100) if shared else MemoryStore(100)
+    limiter = RateLimiter("login", store, ip_rate=60, ip_burst=3, username_rate=6, username_burst=2)
+    assert limiter.take("10.0.0.1", "alice", now=0) is None
+    assert limiter.take("10.0.0.1", "alice", now=0) is None
+    assert limiter.take("10.0.0.1", "alice", now=0) == ("username", 10)
+    # the attempt turned away for alice did not spend the last IP token
+    assert limiter.take("10.0.0.1", "bob", now=0) is None
+    assert limiter.take("10.0.0.1", "carol", now=0) == ("ip", 1)
+    assert limiter.take("10.0.0.1", "carol", now=1) is None
+    assert limiter.take("10.0.0.2", "alice", now=10) is None
+    if shared:
+        # a second worker opening the same file sees the same buckets
+        other = RateLimiter("login", SQLiteStore(store.path, 100), 60, 3, 6, 2)
+        assert other.take("10.0.0.3", "alice", now=10) == ("username", 10)
+
+def test_login_rate_limit(client, monkeypatch):
+    monkeypatch.setattr(login_limiter, "store", MemoryStore(100))
+    attempt = {"username": "throttled", "email": "throttled@example.org", "password": "password"}
+    for _ in range(settings.AUTH_USERNAME_BURST):
+        assert client.post('/auth/login', json=attempt).status_code == 400
+    response = client.post('/auth/login', json=attempt)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    assert server_timing_queries(response.headers["server-timing"]) == 0
+
+def test_create_app(tmp_path, monkeypatch):
+    import apps.dependencies
+    from apps import create_app
+    log_dir = tmp_path / "logs"
+    monkeypatch.setattr(settings, "LOG_DIR", str(log_dir))
+    test_app = create_app()
+    assert test_app is not app
+    assert not log_dir.exists()
+    with TestClient(test_app) as client:
+        assert client.get('/').status_code == 200
+        assert log_dir.is_dir()
+        assert apps.dependencies._engine is not None
+    assert apps.dependencies._engine is None
+
+def test_unhandled_exception(monkeypatch):
+    from apps import create_app
+    monkeypatch.setattr(settings, "DEBUG", False)
+    test_app = create_app()
+
+    @test_app.get('/raises')
+    def raises():
+        raise RuntimeError("unhandled")
+
+    with TestClient(test_app, raise_server_exceptions=False) as client:
+        response = client.get('/raises')
+    assert response.status_code == 500
+    assert response.json() == {"detail": "Internal server error"}
+
+def test_logging_without_listener(capsys):
+    from apps import global_logger, log_queue, stop_logging
+    stop_logging()
+    global_logger.error("Logged before start_logging")
+    assert "Logged before start_logging" in capsys.readouterr().err
+    assert log_queue.qsize() == 0
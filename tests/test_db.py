@@ -1,16 +1,34 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker
-from database.models import User, Followers, Post, Like
+from sqlalchemy.pool import StaticPool
+from sqlalchemy.exc import IntegrityError
+from database.models import Base, User, Followers, Post, Like, Timeline, hot_score, counter_updates
+from database.maintenance import recount_post_counters, rebuild_timelines, rebuild_search_index, rescore_posts
+from apps.export import export_posts_ndjson
+from apps.query_stats import QueryStats, current_stats
+from apps.like_buffer import LikeBuffer
+from apps.search import index_post, unindex_post, search_posts
+from apps.timeline import fan_out_post, backfill_followers, backfill_timeline, backfill_timelines, prune_timeline, timeline_page
+from config import settings
+from apps.dependencies import get_comment_trees, get_comments, paginate_posts_by_cursor, paginate_posts_by_page, \
+    get_identity, identity_cache, get_profile, profile_cache, CommentLimits, get_replies, decode_cursor, \
+    paginate_posts_by_score
+from datetime import datetime
+from types import SimpleNamespace
+import orjson
 import pytest
 
-engine = create_engine('sqlite:///test.db')
+engine = create_engine('sqlite://', poolclass=StaticPool)
 Session = sessionmaker(bind=engine)
 
 @pytest.fixture(scope="function")
 def test_session():
+    Base.metadata.create_all(engine)
     session = Session()
     yield session
     session.rollback()
+    session.close()
+    Base.metadata.drop_all(engine)
 
 def test_user_get(test_session):
     user = User(username="test_user",
@@ -138,3 +156,469 @@ def test_post_comment_and_answer(test_session):
         filter(Post.type == 3). \
         filter(post2.type == 2). \
         first()
+
+def test_comment_tree(test_session):
+    user = User(username="test_user",
+                email="test@example.org",
+                hashed_password="test_password")
+    test_session.add(user)
+    test_session.commit()
+    test_session.refresh(user)
+    post = Post(title="test",
+                content="test",
+                user_id=user.id)
+    test_session.add(post)
+    test_session.commit()
+    test_session.refresh(post)
+    comment = Post(title="comment",
+                   content="comment",
+                   user_id=user.id,
+                   type=2,
+                   refer_to=post.id)
+    hidden_comment = Post(title="hidden",
+                          content="hidden",
+                          user_id=user.id,
+                          type=2,
+                          refer_to=post.id,
+                          hidden=True)
+    test_session.add_all([comment, hidden_comment])
+    test_session.commit()
+    answer = Post(title="answer",
+                  content="answer",
+                  user_id=user.id,
+                  type=3,
+                  refer_to=comment.id)
+    hidden_answer = Post(title="hidden answer",
+                         content="hidden answer",
+                         user_id=user.id,
+                         type=3,
+                         refer_to=hidden_comment.id)
+    test_session.add_all([answer, hidden_answer])
+    test_session.commit()
+    user.like(answer, test_session)
+    test_session.commit()
+    trees = get_comment_trees([post.id, answer.id], test_session)
+    assert trees[answer.id] == []
+    assert trees[post.id] == [{'id': comment.id,
+                               'title': "comment",
+                               'content': "comment",
+                               'user': "test_user",
+                               'date': comment.created_at,
+                               'likes': 0,
+                               'answers': [{'id': answer.id,
+                                            'title': "answer",
+                                            'content': "answer",
+                                            'user': "test_user",
+                                            'date': answer.created_at,
+                                            'likes': 1,
+                                            'answers': []}]}]
+    assert get_comments(post.id, test_session) == trees[post.id]
+
+def test_comment_tree_limits(test_session):
+    user = User(username="test_user",
+                email="test@example.org",
+                hashed_password="test_password")
+    test_session.add(user)
+    test_session.commit()
+    post = Post(title="test", content="test", user_id=user.id, comment_count=3)
+    test_session.add(post)
+    test_session.commit()
+    comments = [Post(title=f"comment {i}", content="comment", user_id=user.id, type=2, refer_to=post.id,
+                     comment_count=1 if i == 0 else 0)
+                for i in range(3)]
+    test_session.add_all(comments)
+    test_session.commit()
+    answer = Post(title="answer", content="answer", user_id=user.id, type=3, refer_to=comments[0].id)
+    test_session.add(answer)
+    test_session.commit()
+
+    tree = get_comments(post.id, test_session, CommentLimits(max_depth=1, max_children=2))
+    assert [comment['id'] for comment in tree] == [comments[0].id, comments[1].id]
+    assert tree[0]['answers'] == []
+    assert tree[0]['reply_count'] == 1
+    assert decode_cursor(tree[0]['cursor']) == [0]
+    assert 'cursor' not in tree[1]
+    assert get_comments(post.id, test_session, CommentLimits(max_depth=0)) == []
+
+    replies, next_cursor = get_replies(post.id, test_session, CommentLimits(max_depth=2, max_children=2))
+    assert [reply['id'] for reply in replies] == [comments[0].id, comments[1].id]
+    assert [reply['id'] for reply in replies[0]['answers']] == [answer.id]
+    assert 'cursor' not in replies[0]
+    replies, next_cursor = get_replies(post.id, test_session, CommentLimits(max_depth=2, max_children=2), next_cursor)
+    assert [reply['id'] for reply in replies] == [comments[2].id]
+    assert next_cursor is None
+
+def test_post_counters(test_session):
+    user = User(username="test_user",
+                email="test@example.org",
+                hashed_password="test_password")
+    user2 = User(username="test_user2",
+                 email="test2@example.org",
+                 hashed_password="test_password2")
+    test_session.add_all([user, user2])
+    test_session.commit()
+    post = Post(title="test",
+                content="test",
+                user_id=user.id)
+    test_session.add(post)
+    test_session.commit()
+    comment = Post(title="comment",
+                   content="comment",
+                   user_id=user2.id,
+                   type=2,
+                   refer_to=post.id)
+    test_session.add(comment)
+    test_session.commit()
+    user2.like(post, test_session)
+    test_session.commit()
+    assert post.like_count == 1
+    user2.remove_like(post, test_session)
+    test_session.commit()
+    assert post.like_count == 0
+    user2.like(post, test_session)
+    test_session.query(Post).filter(Post.id == post.id).update({Post.like_count: 42, Post.comment_count: 42})
+    test_session.commit()
+    recount_post_counters(test_session)
+    test_session.refresh(post)
+    assert (post.like_count, post.comment_count) == (1, 1)
+    comment.hide()
+    test_session.commit()
+    test_session.refresh(post)
+    assert post.comment_count == 0
+    assert recount_post_counters(test_session) == 2
+    test_session.refresh(post)
+    assert post.comment_count == 0
+
+def test_post_scores(test_session, monkeypatch):
+    monkeypatch.setattr(settings, "POSTS_PER_PAGE", 1)
+    user = User(username="test_user",
+                email="test@example.org",
+                hashed_password="test_password")
+    user2 = User(username="test_user2",
+                 email="test2@example.org",
+                 hashed_password="test_password2")
+    test_session.add_all([user, user2])
+    test_session.commit()
+    old_post = Post(title="old", content="old", user_id=user.id, created_at=datetime(2025, 1, 1))
+    new_post = Post(title="new", content="new", user_id=user.id, created_at=datetime(2025, 1, 2))
+    test_session.add_all([old_post, new_post])
+    test_session.commit()
+    assert old_post.hot_score == pytest.approx(hot_score(0, 0, old_post.created_at))
+
+    user2.like(old_post, test_session)
+    test_session.query(Post).filter(Post.id == old_post.id).update(counter_updates(replies=4))
+    test_session.commit()
+    test_session.refresh(old_post)
+    assert old_post.top_score == 1 + 4 * settings.SCORE_REPLY_WEIGHT
+    assert old_post.hot_score == pytest.approx(hot_score(1, 4, old_post.created_at))
+    user2.remove_like(old_post, test_session)
+    test_session.commit()
+    test_session.refresh(old_post)
+    assert old_post.hot_score == pytest.approx(hot_score(0, 4, old_post.created_at))
+
+    hot, after = paginate_posts_by_score(test_session.query(Post), Post.hot_score, None)
+    assert [post.id for post in hot] == [new_post.id]
+    hot, _ = paginate_posts_by_score(test_session.query(Post), Post.hot_score, after)
+    assert [post.id for post in hot] == [old_post.id]
+    top, _ = paginate_posts_by_score(test_session.query(Post), Post.top_score, None)
+    assert [post.id for post in top] == [old_post.id]
+
+    test_session.query(Post).update({Post.hot_score: 0, Post.top_score: 0})
+    test_session.commit()
+    assert rescore_posts(test_session) == 2
+    test_session.refresh(old_post)
+    assert old_post.top_score == 4 * settings.SCORE_REPLY_WEIGHT
+    assert old_post.hot_score == pytest.approx(hot_score(0, 4, old_post.created_at))
+
+def test_post_cursor_pagination(test_session):
+    user = User(username="test_user",
+                email="test@example.org",
+                hashed_password="test_password")
+    test_session.add(user)
+    test_session.commit()
+    same_time = datetime(2024, 5, 26)
+    test_session.add_all([Post(title=f"test{i}",
+                               content="test",
+                               user_id=user.id,
+                               created_at=same_time if i % 2 else datetime(2024, 5, 1, i))
+                          for i in range(20)])
+    test_session.commit()
+    query = test_session.query(Post).filter(Post.type == 1)
+    first_page, cursor = paginate_posts_by_cursor(query, None)
+    second_page, last_cursor = paginate_posts_by_cursor(query, cursor)
+    assert cursor is not None and last_cursor is None
+    assert len(first_page) == 15 and len(second_page) == 5
+    assert first_page == paginate_posts_by_page(query, 1)
+    assert second_page == paginate_posts_by_page(query, 2)
+    ordered = sorted(first_page + second_page, key=lambda post: (post.created_at, post.id), reverse=True)
+    assert first_page + second_page == ordered
+
+def test_identity_cache(test_session):
+    user = User(username="test_user",
+                email="test@example.org",
+                hashed_password="test_password")
+    test_session.add(user)
+    test_session.commit()
+    request = SimpleNamespace(state=SimpleNamespace(user={"sub": "test_user", "uid": user.id}))
+    identity_cache.clear()
+    identity = get_identity(request, test_session)
+    assert identity == (user.id, "test_user", 1)
+    assert identity_cache.get(user.id) == identity
+    user.username = "test_user_renamed"
+    user.role_id = 2
+    test_session.flush()
+    # a concurrent request that read the row before the commit caches the old identity
+    identity_cache.set(user.id, identity)
+    test_session.commit()
+    assert identity_cache.get(user.id) is None
+    assert get_identity(request, test_session) == (user.id, "test_user_renamed", 2)
+
+def test_timeline(test_session, monkeypatch):
+    monkeypatch.setattr(settings, "TIMELINE_FANOUT_LIMIT", 1)
+    reader = User(username="test_reader",
+                  email="reader@example.org",
+                  hashed_password="test_password")
+    other_reader = User(username="test_other_reader",
+                        email="other_reader@example.org",
+                        hashed_password="test_password")
+    author = User(username="test_author",
+                  email="author@example.org",
+                  hashed_password="test_password")
+    popular = User(username="test_popular",
+                   email="popular@example.org",
+                   hashed_password="test_password")
+    test_session.add_all([reader, other_reader, author, popular])
+    test_session.commit()
+    old_post = Post(title="old", content="test", user_id=author.id, created_at=datetime(2024, 5, 1))
+    test_session.add(old_post)
+    test_session.commit()
+    reader.follow(author, test_session)
+    backfill_timeline(reader.id, author.id, test_session)
+    reader.follow(popular, test_session)
+    other_reader.follow(popular, test_session)
+    test_session.commit()
+    posts = [Post(title=f"test{i}", content="test", user_id=(author, popular)[i % 2].id,
+                  created_at=datetime(2024, 5, 2, i))
+             for i in range(20)]
+    for post in posts:
+        test_session.add(post)
+        test_session.flush()
+        fan_out_post(post, test_session)
+    test_session.commit()
+    assert test_session.query(Timeline).filter(Timeline.author_id == popular.id).count() == 0
+    expected = sorted(posts + [old_post], key=lambda post: post.created_at, reverse=True)
+    first_page, cursor = timeline_page(reader, test_session, after=None)
+    second_page, last_cursor = timeline_page(reader, test_session, after=cursor)
+    assert first_page + second_page == expected and last_cursor is None
+    assert timeline_page(reader, test_session, page=2)[0] == second_page
+    assert rebuild_timelines(test_session) == 11
+    assert timeline_page(reader, test_session, after=cursor)[0] == second_page
+    reader.unfollow(author, test_session)
+    prune_timeline(reader.id, author.id, test_session)
+    test_session.commit()
+    assert timeline_page(reader, test_session)[0] == [post for post in expected if post.user_id == popular.id][:15]
+
+    monkeypatch.setattr(settings, "TIMELINE_BACKFILL", 5)
+    followed = other_reader.follow_many([author.id, popular.id], test_session)
+    backfill_timelines(other_reader.id, sorted(followed), test_session)
+    test_session.commit()
+    assert followed == {author.id}
+    assert [entry.post_id for entry in test_session.query(Timeline).
+            filter(Timeline.user_id == other_reader.id).
+            order_by(Timeline.created_at.desc())] == \
+        [post.id for post in expected if post.user_id == author.id][:5]
+
+    # popular drops back to the fan-out limit, its latest posts are fanned out to reader
+    other_reader.unfollow(popular, test_session)
+    backfill_followers(popular.id, test_session)
+    test_session.commit()
+    assert [entry.post_id for entry in test_session.query(Timeline).
+            filter(Timeline.user_id == reader.id).
+            filter(Timeline.author_id == popular.id).
+            order_by(Timeline.created_at.desc())] == \
+        [post.id for post in expected if post.user_id == popular.id][:5]
+
+def test_like_and_follow_once(test_session):
+    user = User(username="test_user",
+                email="test@example.org",
+                hashed_password="test_password")
+    user2 = User(username="test_user2",
+                 email="test2@example.org",
+                 hashed_password="test_password2")
+    test_session.add_all([user, user2])
+    test_session.commit()
+    post = Post(title="test",
+                content="test",
+                user_id=user2.id)
+    test_session.add(post)
+    test_session.commit()
+    assert user.like(post, test_session)
+    assert not user.like(post, test_session)
+    assert user.follow(user2, test_session)
+    assert not user.follow(user2, test_session)
+    test_session.commit()
+    assert (post.like_count, user2.followers_count) == (1, 1)
+    assert user.remove_like(post, test_session)
+    assert not user.remove_like(post, test_session)
+    assert user.unfollow(user2, test_session)
+    assert not user.unfollow(user2, test_session)
+    test_session.commit()
+    assert (post.like_count, user2.followers_count) == (0, 0)
+    test_session.add(User(username="test_user",
+                          email="other@example.org",
+                          hashed_password="test_password"))
+    with pytest.raises(IntegrityError):
+        test_session.commit()
+
+def test_query_stats_failed_statement(test_session):
+    test_session.add(User(username="test_user", email="test@example.org", hashed_password="test_password"))
+    test_session.commit()
+    stats = QueryStats()
+    token = current_stats.set(stats)
+    try:
+        test_session.add(User(username="test_user", email="other@example.org", hashed_password="test_password"))
+        with pytest.raises(IntegrityError):
+            test_session.commit()
+        test_session.rollback()
+        assert test_session.query(User).count() == 1
+    finally:
+        current_stats.reset(token)
+    assert stats.count == 2
+    assert any(statement.startswith("INSERT INTO users") for statement in stats.statements)
+
+def test_export_posts(test_session, monkeypatch):
+    monkeypatch.setattr(settings, "EXPORT_BATCH_SIZE", 2)
+    user = User(username="test_user",
+                email="test@example.org",
+                hashed_password="test_password")
+    test_session.add(user)
+    test_session.commit()
+    posts = [Post(title=f"post {i}", content="test", user_id=user.id, created_at=datetime(2024, 5, i + 1))
+             for i in range(5)]
+    test_session.add_all(posts)
+    test_session.commit()
+    test_session.add(Post(title="comment", content="test", user_id=user.id, type=2, refer_to=posts[0].id))
+    posts[1].hide()
+    test_session.commit()
+
+    chunks = list(export_posts_ndjson(test_session))
+    assert len(chunks) == 2
+    lines = [orjson.loads(line) for line in b"".join(chunks).splitlines()]
+    assert [line["id"] for line in lines] == [posts[0].id, posts[2].id, posts[3].id, posts[4].id]
+    assert lines[0]["user"] == "test_user"
+    lines = b"".join(export_posts_ndjson(test_session, since=datetime(2024, 5, 2), until=datetime(2024, 5, 4),
+                                         include_hidden=True)).splitlines()
+    assert [orjson.loads(line)["id"] for line in lines] == [posts[1].id, posts[2].id]
+    lines = b"".join(export_posts_ndjson(test_session, include_comments=True)).splitlines()
+    assert orjson.loads(lines[-1])["refer_to"] == posts[0].id
+
+def test_search_posts(test_session, monkeypatch):
+    monkeypatch.setattr(settings, "POSTS_PER_PAGE", 2)
+    user = User(username="test_user",
+                email="test@example.org",
+                hashed_password="test_password")
+    test_session.add(user)
+    test_session.commit()
+    posts = [Post(title="cats", content="cats and dogs " + "words " * i, user_id=user.id) for i in range(3)]
+    posts.append(Post(title="dogs", content="only dogs", user_id=user.id))
+    test_session.add_all(posts)
+    test_session.flush()
+    for post in posts:
+        index_post(post, test_session)
+    test_session.commit()
+
+    found, next_cursor = search_posts(test_session, "cat", None)
+    assert [post.id for post in found] == [posts[0].id, posts[1].id]
+    found, next_cursor = search_posts(test_session, "cat", next_cursor)
+    assert ([post.id for post in found], next_cursor) == ([posts[2].id], None)
+    posts[0].hide()
+    unindex_post(posts[0], test_session)
+    test_session.commit()
+    assert [post.id for post in search_posts(test_session, "cats dogs", None)[0]] == [posts[1].id, posts[2].id]
+    assert rebuild_search_index(test_session) == 3
+    assert len(search_posts(test_session, "dog", None)[0]) == 2
+
+def test_like_buffer(test_session, monkeypatch):
+    monkeypatch.setattr(settings, "LIKE_FLUSH_INTERVAL", 60000)
+    buffer = LikeBuffer(Session)
+    user = User(username="test_user",
+                email="test@example.org",
+                hashed_password="test_password")
+    user2 = User(username="test_user2",
+                 email="test2@example.org",
+                 hashed_password="test_password2")
+    test_session.add_all([user, user2])
+    test_session.commit()
+    post = Post(title="test", content="test", user_id=user2.id)
+    other_post = Post(title="other", content="test", user_id=user2.id)
+    test_session.add_all([post, other_post])
+    test_session.commit()
+    assert user2.like(other_post, test_session)
+    test_session.commit()
+
+    assert buffer.like(user.id, post.id, test_session)
+    assert not buffer.like(user.id, post.id, test_session)
+    assert buffer.remove_like(user2.id, other_post.id, test_session)
+    assert buffer.like(user2.id, post.id, test_session)
+    assert buffer.remove_like(user2.id, post.id, test_session)
+    assert (buffer.like_count(post.id, 0), buffer.like_count(other_post.id, 1)) == (1, 0)
+    assert buffer.pending() == 2
+    assert test_session.query(Like).count() == 1
+
+    assert buffer.flush() == 2
+    test_session.expire_all()
+    assert [(like.user_id, like.post_id) for like in test_session.query(Like)] == [(user.id, post.id)]
+    assert (post.like_count, other_post.like_count) == (1, 0)
+    assert (buffer.like_count(post.id, 1), buffer.pending()) == (1, 0)
+    assert not buffer.like(user.id, post.id, test_session)
+
+    def failing_write(entries, db):
+        # the like being flushed is taken back before the flush fails
+        assert buffer.remove_like(user2.id, other_post.id, test_session)
+        raise RuntimeError("flush failed")
+
+    assert buffer.like(user2.id, other_post.id, test_session)
+    buffer._write = failing_write
+    assert buffer.flush() == 0
+    del buffer._write
+    assert (buffer.like_count(other_post.id, 0), buffer.pending()) == (0, 0)
+    assert buffer.flush() == 0
+    assert buffer.like_count(other_post.id, 0) == 0
+    buffer.stop()
+
+def test_profile_stats(test_session):
+    profile_cache.clear()
+    user = User(username="test_user",
+                email="test@example.org",
+                hashed_password="test_password")
+    user2 = User(username="test_user2",
+                 email="test2@example.org",
+                 hashed_password="test_password2")
+    test_session.add_all([user, user2])
+    test_session.commit()
+    post = Post(title="test", content="test", user_id=user.id)
+    hidden_post = Post(title="hidden", content="test", user_id=user.id, hidden=True, like_count=5)
+    test_session.add_all([post, hidden_post])
+    test_session.commit()
+    test_session.add(Post(title="comment", content="test", user_id=user.id, type=2, refer_to=post.id))
+    user2.like(post, test_session)
+    user2.follow(user, test_session)
+    user.follow(user2, test_session)
+    test_session.commit()
+
+    user_id = user.id
+    statements = []
+
+    def count_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", count_statement)
+    try:
+        profile = get_profile(user_id, test_session)
+        assert get_profile(user_id, test_session) is profile
+    finally:
+        event.remove(engine, "before_cursor_execute", count_statement)
+    assert len(statements) == 1
+    assert {key: value for key, value in profile.items() if key != "last_seen"} == \
+           {"username": "test_user", "followers": 1, "following": 1, "posts": 1, "likes": 1}
+    assert get_profile(12345, test_session) is None
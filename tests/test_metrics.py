@@ -0,0 +1,42 @@
+import pytest
+from threading import Thread
+from fastapi.testclient import TestClient
+from apps import app
+from apps.metrics import Counter, Histogram
+
+@pytest.fixture
+def client():
+    with TestClient(app) as client:
+        yield client
+
+def test_metrics(client):
+    client.get('/')
+    client.get('/no-such-route')
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    assert any(line.startswith('http_requests_total{method="GET",route="/",status="200"} ') for line in lines)
+    assert any(line.startswith('http_requests_total{method="GET",route="<unmatched>",status="404"} ') for line in lines)
+    assert any(line.startswith('http_request_duration_seconds_bucket{method="GET",route="/",le="+Inf"} ')
+               for line in lines)
+    assert "# TYPE db_pool_checkout_wait_seconds histogram" in lines
+    assert "bcrypt_queue_depth 0" in lines
+
+def test_metric_shards_of_exited_threads():
+    counter = Counter("test_total", "Test counter.", labels=("kind",))
+    histogram = Histogram("test_seconds", "Test histogram.", buckets=(1.0,))
+
+    def record():
+        counter.inc("a")
+        histogram.observe(0.5)
+
+    for _ in range(3):
+        thread = Thread(target=record)
+        thread.start()
+        thread.join()
+    counter.inc("a")
+    assert counter.collect() == {("a",): 4}
+    assert histogram.collect() == {(): [3, 0, 1.5]}
+    assert len(counter._shards) == 1 and len(histogram._shards) == 0
+    assert counter.collect() == {("a",): 4}